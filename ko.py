@@ -139,16 +139,40 @@ tail -f nohup.out
 from __future__ import print_function
 import argparse
 from argparse import RawDescriptionHelpFormatter
+from collections import Counter
+from collections import namedtuple
+import fcntl
+import glob
+import hashlib
+import json
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import platform
 import random
 import re
+import select
+import shutil
+import socket
+import struct
 import subprocess
 import sys
 import tarfile
+import threading
 import time
 
+try:
+    from urllib2 import HTTPError, Request, URLError, urlopen
+except ImportError:
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 
 logger = logging.getLogger(__name__)
 
@@ -166,6 +190,234 @@ KOLLA_FINAL_PROGRESS = 0
 global K8S_CLEANUP_PROGRESS
 K8S_CLEANUP_PROGRESS = 0
 
+# Remote artifacts, fetched through the artifact cache
+GET_PIP_URL = 'https://bootstrap.pypa.io/get-pip.py'
+K8S_APT_KEY_URL = 'https://packages.cloud.google.com/apt/doc/apt-key.gpg'
+CANAL_RBAC_URL = 'https://raw.githubusercontent.com/projectcalico/canal/' \
+    'master/k8s-install/1.7/rbac.yaml'
+CANAL_URL = 'https://raw.githubusercontent.com/projectcalico/canal/' \
+    'master/k8s-install/1.7/canal.yaml'
+WEAVE_URL = 'https://cloud.weave.works/k8s/net?k8s-version=%s'
+HELM_URL = 'https://storage.googleapis.com/kubernetes-helm/' \
+    'helm-v%s-linux-amd64.tar.gz'
+CIRROS_URL = 'http://download.cirros-cloud.net/0.4.0/' \
+    'cirros-0.4.0-x86_64-disk.img'
+
+# Kolla git repos: name: url
+KOLLA_REPOS = {
+    'kolla-ansible': 'http://github.com/openstack/kolla-ansible',
+    'kolla-kubernetes': 'http://github.com/openstack/kolla-kubernetes',
+}
+
+# Background prefetches started by prefetch_artifacts: url or repo name to
+# their AsyncResult
+global PREFETCHES
+PREFETCHES = {}
+
+# Artifacts already downloaded or revalidated during this run
+global FETCHED_ARTIFACTS
+FETCHED_ARTIFACTS = set()
+
+# Packages installed on the host, per distro and phase. A run installs all
+# the phases it needs in one transaction, see install_host_packages.
+# "%(k8s)s" is replaced by the kubernetes version.
+PACKAGES = {
+    'centos': {
+        'docker': ['docker'],
+        'tools': ['qemu', 'bridge-utils', 'python-pip', 'python-devel',
+                  'libffi-devel', 'gcc', 'openssl-devel', 'sshpass', 'git',
+                  'crudini', 'jq', 'ansible', 'curl', 'lvm2', 'pigz'],
+        'ntp': ['ntp'],
+        'kubernetes': ['ebtables', 'kubelet-%(k8s)s', 'kubeadm-%(k8s)s',
+                       'kubectl-%(k8s)s', 'kubernetes-cni'],
+    },
+    'ubuntu': {
+        'docker': ['docker.io'],
+        'tools': ['qemu', 'bridge-utils', 'python-dev', 'libffi-dev', 'gcc',
+                  'libssl-dev', 'python-pip', 'sshpass', 'git', 'crudini',
+                  'jq', 'ansible', 'curl', 'lvm2', 'pigz'],
+        'ntp': ['ntp'],
+        # todo - this breaks when ubuntu steps up a revision to -01 etc
+        'kubernetes': ['ebtables', 'kubelet=%(k8s)s-00', 'kubeadm=%(k8s)s-00',
+                       'kubectl=%(k8s)s-00', 'kubernetes-cni'],
+    },
+}
+
+# Free addresses found by subnet sweeps, so a subnet is only swept once
+global SUBNET_SWEEPS
+SUBNET_SWEEPS = {}
+
+# Encapsulation overhead of VXLAN over IPv4, as used by canal (flannel),
+# weave (fastdp) and the neutron tenant networks
+VXLAN_OVERHEAD = 50
+
+# Messages already passed on from the sudo'd helper
+global NET_WARNINGS
+NET_WARNINGS = set()
+
+# Runs a function of this script as root, see sudo_call. The script is
+# loaded by path, as it is not always named ko.py.
+SUDO_HELPER = """
+import json, sys
+try:
+    import importlib.util
+    from importlib.machinery import SourceFileLoader
+    loader = SourceFileLoader('ko', sys.argv[1])
+    ko = importlib.util.module_from_spec(
+        importlib.util.spec_from_file_location('ko', sys.argv[1],
+                                               loader=loader))
+    loader.exec_module(ko)
+except ImportError:
+    import imp
+    ko = imp.load_source('ko', sys.argv[1])
+print(json.dumps(getattr(ko, sys.argv[2])(*json.loads(sys.argv[3]))))
+"""
+
+# Result of probing an address: alive is True if it answered, method is
+# "arp", "icmp" or "none" (probing failed), mac is the answering MAC
+# (ARP only), rtt is in seconds
+ProbeResult = namedtuple('ProbeResult', ['ip', 'alive', 'method', 'mac',
+                                         'rtt'])
+
+# OpenStack API endpoints probed by the readiness gates:
+# API name: (kolla service name, url path)
+OPENSTACK_APIS = {
+    'keystone': ('keystone-public', '/v3'),
+    'glance': ('glance-api', '/'),
+    'nova': ('nova-api', '/'),
+    'neutron': ('neutron-server', '/'),
+    'placement': ('placement-api', '/'),
+}
+
+# Control plane images of kubeadm releases without "kubeadm config images
+# list": kubernetes minor version: (etcd version, kube-dns version)
+KUBEADM_IMAGES = {
+    '1.8': ('3.0.17', '1.14.5'),
+    '1.9': ('3.1.10', '1.14.7'),
+    '1.10': ('3.1.12', '1.14.8'),
+}
+
+# Settings kolla-kubernetes needs in /etc/kolla/globals.yml besides the
+# interfaces and VIP, see kolla_globals_model
+KOLLA_GLOBALS = [
+    ('kolla_install_type', 'source'),
+    ('tempest_image_alt_id', '{{ tempest_image_id }}'),
+    ('tempest_flavor_ref_alt_id', '{{ tempest_flavor_ref_id }}'),
+    ('neutron_plugin_agent', 'openvswitch'),
+    ('api_interface_address', '0.0.0.0'),
+    ('tunnel_interface_address', '0.0.0.0'),
+    ('orchestration_engine', 'KUBERNETES'),
+    ('memcached_servers', 'memcached'),
+    ('keystone_admin_url', 'http://keystone-admin:35357/v3'),
+    ('keystone_internal_url', 'http://keystone-internal:5000/v3'),
+    ('keystone_public_url', 'http://keystone-public:5000/v3'),
+    ('glance_registry_host', 'glance-registry'),
+    ('neutron_host', 'neutron'),
+    ('keystone_database_address', 'mariadb'),
+    ('glance_database_address', 'mariadb'),
+    ('nova_database_address', 'mariadb'),
+    ('nova_api_database_address', 'mariadb'),
+    ('neutron_database_address', 'mariadb'),
+    ('cinder_database_address', 'mariadb'),
+    ('ironic_database_address', 'mariadb'),
+    ('placement_database_address', 'mariadb'),
+    ('rabbitmq_servers', 'rabbitmq'),
+    ('openstack_logging_debug', 'True'),
+    ('enable_haproxy', 'no'),
+    ('enable_heat', 'no'),
+    ('enable_cinder', 'yes'),
+    ('enable_cinder_backend_lvm', 'yes'),
+    ('enable_cinder_backend_iscsi', 'yes'),
+    ('enable_cinder_backend_rbd', 'no'),
+    ('enable_ceph', 'no'),
+    ('enable_elasticsearch', 'no'),
+    ('enable_kibana', 'no'),
+    ('glance_backend_ceph', 'no'),
+    ('cinder_backend_ceph', 'no'),
+    ('nova_backend_ceph', 'no'),
+    ('enable_neutron_provider_networks', 'yes'),
+]
+
+# The OpenStack service charts that are installed, in install order, with
+# the services each one needs running first. The dependencies are read
+# from the charts' values where possible, see kolla_service_graph, this
+# table is the fallback.
+KOLLA_SERVICE_DEPS = [
+    ('openvswitch', []),
+    ('mariadb', []),
+    ('rabbitmq', []),
+    ('memcached', []),
+    ('keystone', ['mariadb', 'memcached']),
+    ('glance', ['keystone', 'rabbitmq']),
+    ('cinder-control', ['keystone', 'rabbitmq']),
+    ('cinder-volume-lvm', ['cinder-control']),
+    ('horizon', ['keystone']),
+    ('neutron', ['keystone', 'rabbitmq', 'openvswitch']),
+    ('nova-control', ['keystone', 'rabbitmq', 'glance', 'neutron']),
+    ('nova-compute', ['nova-control']),
+]
+
+# The config maps kollakube creates from the configs in /etc/kolla
+KOLLA_CONFIG_MAPS = [
+    'mariadb', 'keystone', 'horizon', 'rabbitmq', 'memcached', 'nova-api',
+    'nova-conductor', 'nova-scheduler', 'glance-api-haproxy',
+    'glance-registry-haproxy', 'glance-api', 'glance-registry',
+    'neutron-server', 'neutron-dhcp-agent', 'neutron-l3-agent',
+    'neutron-metadata-agent', 'neutron-openvswitch-agent',
+    'openvswitch-db-server', 'openvswitch-vswitchd', 'nova-libvirt',
+    'nova-compute', 'nova-consoleauth', 'nova-novncproxy',
+    'nova-novncproxy-haproxy', 'neutron-server-haproxy', 'nova-api-haproxy',
+    'cinder-api', 'cinder-api-haproxy', 'cinder-backup', 'cinder-scheduler',
+    'cinder-volume', 'iscsid', 'tgtd', 'keepalived', 'placement-api',
+    'placement-api-haproxy',
+]
+
+# The kolla-kubernetes scripts helm_build_all.sh runs before packaging:
+# they write the values.yaml of the microservices, services and compute
+# kits from helm/all_values.yaml
+KOLLA_CHART_PREBUILDS = [
+    './kolla-kubernetes/tools/helm_prebuild_microservices.py',
+    './kolla-kubernetes/tools/helm_prebuild_services.py',
+    './kolla-kubernetes/tools/helm_prebuild_compute_kits.py',
+]
+
+# Builds the compute kits with their duplicate templates removed, which
+# keeps a kit release under the 1MB configmap limit
+KOLLA_COMPUTE_KIT_BUILD = './kolla-kubernetes/tools/helm_build_compute_kits.py'
+global COMPUTE_KIT_LOCK
+COMPUTE_KIT_LOCK = threading.Lock()
+
+# Index of the built helm charts, see kolla_write_chart_manifest
+CHART_MANIFEST = '/tmp/kolla-charts.json'
+global CHART_INDEX
+CHART_INDEX = {}
+
+# Port of the pull-through registry started by --registry_mirror local
+REGISTRY_MIRROR_PORT = 4000
+
+# Kolla images run by each service chart, in the order the charts are
+# installed. The tag of an image comes from the <image>_image_tag value
+# in cloud.yaml if there is one, like kolla_toolbox_image_tag. Only used
+# until the charts can be rendered, see kolla_plan_images.
+KOLLA_CHART_IMAGES = [
+    ('common', ['kolla-toolbox', 'kubernetes-entrypoint', 'haproxy']),
+    ('openvswitch', ['openvswitch-db-server', 'openvswitch-vswitchd']),
+    ('mariadb', ['mariadb']),
+    ('rabbitmq', ['rabbitmq']),
+    ('memcached', ['memcached']),
+    ('keystone', ['keystone', 'keystone-fernet', 'keystone-ssh']),
+    ('glance', ['glance-api', 'glance-registry']),
+    ('cinder-control', ['cinder-api', 'cinder-scheduler']),
+    ('cinder-volume-lvm', ['cinder-volume', 'tgtd', 'iscsid']),
+    ('horizon', ['horizon']),
+    ('neutron', ['neutron-server', 'neutron-dhcp-agent', 'neutron-l3-agent',
+                 'neutron-metadata-agent', 'neutron-openvswitch-agent']),
+    ('nova-control', ['nova-api', 'nova-scheduler', 'nova-conductor',
+                      'nova-consoleauth', 'nova-novncproxy',
+                      'nova-placement-api']),
+    ('nova-compute', ['nova-compute', 'nova-libvirt', 'nova-ssh']),
+]
+
 
 def set_logging():
     '''Set basic logging format.'''
@@ -268,6 +520,9 @@ def parse_args():
     parser.add_argument('-ng', '--no_git', action='store_true',
                         help='Select this to not override git repos '
                         'previously downloaded')
+    parser.add_argument('-gr', '--git_ref', type=str, default='master',
+                        help='Specify a branch, tag or commit of the kolla '
+                        'repos to check out, the default(master)')
     parser.add_argument('-bd', '--base_distro', type=str, default='centos',
                         help='Specify a base container image to '
                         'the default(centos), like "ubuntu"')
@@ -284,6 +539,46 @@ def parse_args():
     parser.add_argument('-cw', '--cinder_wip', action='store_true',
                         help='Experimental, add specific configs to '
                         'cinder.conf')
+    parser.add_argument('-cd', '--cache_dir', type=str, default='~/.ko',
+                        help='Specify a different directory for the cache '
+                        'kept between runs to the default(~/.ko)')
+    parser.add_argument('-off', '--offline', action='store_true',
+                        help='Do not download anything, serve all '
+                        'artifacts from the cache of a previous run')
+    parser.add_argument('-pc', '--pull_concurrency', type=int, default=4,
+                        help='Specify a different number of docker images '
+                        'to pull at the same time to the default(4)')
+    parser.add_argument('-bs', '--bundle_save', action='store_true',
+                        help='Save the OpenStack docker images in a bundle '
+                        'in the cache after deployment')
+    parser.add_argument('-bl', '--bundle_load', action='store_true',
+                        help='Load the OpenStack docker images from a bundle '
+                        'saved by --bundle_save instead of pulling them')
+    parser.add_argument('-rm', '--registry_mirror', type=str, default='None',
+                        help='Pull images through a registry mirror, '
+                        '"local" to run one on this host or host:port of an '
+                        'existing one')
+    parser.add_argument('-pi', '--parallel_install', type=int, default=0,
+                        help='Install up to this many independent helm '
+                        'charts at the same time, the default(0) installs '
+                        'every chart whose dependencies are ready, 1 '
+                        'installs them one by one')
+    parser.add_argument('-ba', '--bulk_apply', action='store_true',
+                        help='Render the service charts with helm template '
+                        'and apply them with kubectl instead of installing '
+                        'them through Tiller, needs helm 2.8 or later. '
+                        'There are no helm releases to list or '
+                        '--reconfigure then')
+    parser.add_argument('-rc', '--reconfigure', action='store_true',
+                        help='Regenerate globals.yml, the config maps '
+                        'and cloud.yaml for a running deployment and helm '
+                        'upgrade only the releases they change')
+    parser.add_argument('-kt', '--keep_tags', type=int, default=2,
+                        help='Specify a different number of kolla image tags '
+                        'to keep on cleanup to the default(2)')
+    parser.add_argument('-ib', '--image_budget', type=float, default=40,
+                        help='Specify a different disk budget in GB for '
+                        'docker images kept on cleanup to the default(40)')
 
     return parser.parse_args()
 
@@ -291,6 +586,15 @@ def parse_args():
 def run_shell(args, cmd):
     '''Run a shell command and return the output
 
+    For commands whose failure is not checked, see run_shell_status
+    '''
+
+    return(run_shell_status(args, cmd)[1])
+
+
+def run_shell_status(args, cmd):
+    '''Run a shell command and return its exit code, output and errors
+
     Print the output and errors if debug is enabled
     Not using logger.debug as a bit noisy for this info
     '''
@@ -315,7 +619,7 @@ def run_shell(args, cmd):
         if err:
             print("Shell STDERR output: \n'%s'\n" % err)
 
-    return(out)
+    return(p.returncode, out, err)
 
 
 def add_line(file, marker, addition):
@@ -339,6 +643,39 @@ def untar(fname):
         tar.close()
 
 
+def ko_cache_dir(args, name):
+    '''Return a directory in the persistent cache, creating it if needed
+
+    The cache lives outside /tmp so that it survives k8s_cleanup
+    '''
+
+    path = os.path.join(os.path.expanduser(args.cache_dir), name)
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return(path)
+
+
+def load_json(path, default):
+    '''Load a json file, or return default if it does not exist'''
+
+    if not os.path.exists(path):
+        return(default)
+    with open(path) as f:
+        return(json.load(f))
+
+
+def save_json(path, data):
+    '''Atomically write data to a json file'''
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as w:
+        json.dump(data, w, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
 def pause_tool_execution(str):
     '''Pause the script for manual debugging of the VM before continuing'''
 
@@ -402,18 +739,172 @@ def demo(args, title, description):
         print('Demo: Continuing with Demo')
 
 
-def curl(*args):
-    '''Use curl to retrieve a file from a URI'''
+def file_sha256(path):
+    '''Return the sha256 hex digest of a file'''
 
-    curl_path = '/usr/bin/curl'
-    curl_list = [curl_path]
-    for arg in args:
-        curl_list.append(arg)
-    curl_result = subprocess.Popen(
-        curl_list,
-        stderr=subprocess.PIPE,
-        stdout=subprocess.PIPE).communicate()[0]
-    return curl_result
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return(digest.hexdigest())
+
+
+def fetch_artifact(args, url, dest=None, sha256=None, prefetched=True):
+    '''Fetch a file from a URI through the persistent artifact cache
+
+    Artifacts are stored by content checksum, with an index from url to
+    checksum and the server's ETag and Last-Modified. A cached artifact is
+    revalidated with a conditional request, once per run, and only
+    downloaded again when it changed, or when it does not match sha256 if
+    one is given. With --offline the cached copy is served without asking
+    the server. If a prefetch of url is running, wait for it first unless
+    prefetched is False.
+
+    The artifact is copied to dest, if given.
+    '''
+
+    if prefetched and url in PREFETCHES:
+        PREFETCHES[url].wait()
+
+    objects = ko_cache_dir(args, 'artifacts/objects')
+    index = os.path.join(
+        ko_cache_dir(args, 'artifacts/urls'),
+        hashlib.sha256(url.encode()).hexdigest() + '.json')
+    meta = load_json(index, {})
+    cached = 'sha256' in meta and \
+        os.path.exists(os.path.join(objects, meta['sha256'])) and \
+        (sha256 is None or meta['sha256'] == sha256)
+
+    if args.offline:
+        if not cached:
+            raise AbortScriptException(
+                'Offline - %s is not in the artifact cache' % url)
+    elif not cached or url not in FETCHED_ARTIFACTS:
+        headers = {}
+        if cached and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if cached and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=60)
+            tmp = os.path.join(objects, os.path.basename(index) + '.tmp')
+            digest = hashlib.sha256()
+            with open(tmp, 'wb') as w:
+                for chunk in iter(lambda: response.read(1 << 20), b''):
+                    digest.update(chunk)
+                    w.write(chunk)
+            meta = {'url': url,
+                    'sha256': digest.hexdigest(),
+                    'etag': response.info().get('ETag'),
+                    'last_modified': response.info().get('Last-Modified')}
+            response.close()
+            os.rename(tmp, os.path.join(objects, meta['sha256']))
+            save_json(index, meta)
+            logger.debug('Downloaded %s' % url)
+        except (URLError, IOError) as e:
+            # HTTPError is a URLError, a 304 or a server error is no reason
+            # to fail while there is a cached copy
+            if not cached:
+                raise
+            if isinstance(e, HTTPError) and e.code == 304:
+                logger.debug('Cached %s is still valid' % url)
+            else:
+                print('  *Can not revalidate %s (%s), using cached copy*' %
+                      (url, e))
+        FETCHED_ARTIFACTS.add(url)
+
+    if sha256 is not None and meta['sha256'] != sha256:
+        raise AbortScriptException(
+            '%s does not match checksum %s' % (url, sha256))
+    if dest is not None:
+        shutil.copyfile(os.path.join(objects, meta['sha256']), dest)
+
+
+def prefetch_artifact(args, url):
+    '''Fetch an artifact into the cache, for use in the background'''
+
+    try:
+        fetch_artifact(args, url, prefetched=False)
+    except Exception as e:
+        # The step that needs it will try again and report the error
+        logger.debug('Prefetch of %s failed: %s' % (url, e))
+
+
+def git_update_mirror(args, name):
+    '''Create or incrementally update the bare mirror of a kolla repo
+
+    The mirrors are kept in the cache, so after the first run only new
+    objects are fetched. Returns the path to the mirror.
+    '''
+
+    mirror = os.path.join(ko_cache_dir(args, 'git'), '%s.git' % name)
+    if args.offline:
+        if not os.path.exists(mirror):
+            raise AbortScriptException(
+                'Offline - no git mirror of %s' % name)
+    elif os.path.exists(mirror):
+        run_shell(args, 'git --git-dir=%s fetch -q --prune origin' % mirror)
+    else:
+        run_shell(args, 'git clone -q --mirror %s %s' %
+                  (KOLLA_REPOS[name], mirror))
+    return(mirror)
+
+
+def prefetch_repo(args, name):
+    '''Update the mirror of a kolla repo, for use in the background'''
+
+    try:
+        git_update_mirror(args, name)
+    except Exception as e:
+        logger.debug('Prefetch of %s failed: %s' % (name, e))
+
+
+def prefetch_artifacts(args):
+    '''Start fetching every remote artifact this run needs
+
+    The URLs are worked out from the options, then all of them are fetched
+    concurrently in the background while the packages install. Each step
+    then finds its artifact on local disk. The weave manifest depends on the
+    running cluster so it can not be prefetched.
+    '''
+
+    urls = []
+    if not args.openstack:
+        urls.append(GET_PIP_URL)
+        if linux_ver() == 'ubuntu':
+            urls.append(K8S_APT_KEY_URL)
+        if args.cni != 'weave':
+            urls.extend([CANAL_RBAC_URL, CANAL_URL])
+    if not args.kubernetes and not args.create_minion:
+        urls.append(HELM_URL % args.helm_version)
+        if not args.no_network:
+            urls.append(CIRROS_URL)
+    if not urls:
+        return
+
+    print('Prefetching %d artifacts in the background' % len(urls))
+    pool = ThreadPool(len(urls))
+    for url in urls:
+        PREFETCHES[url] = pool.apply_async(prefetch_artifact, (args, url))
+    pool.close()
+
+
+def prefetch_repos(args):
+    '''Start updating the git mirrors of the kolla repos
+
+    Run after install_host_packages, as git is not there on a fresh host.
+    '''
+
+    if args.kubernetes or args.create_minion or args.no_git or \
+            args.offline:
+        return
+
+    repos = sorted(KOLLA_REPOS)
+    print('Prefetching %d git repos in the background' % len(repos))
+    pool = ThreadPool(len(repos))
+    for name in repos:
+        PREFETCHES[name] = pool.apply_async(prefetch_repo, (args, name))
+    pool.close()
 
 
 def linux_ver():
@@ -493,18 +984,27 @@ def tools_versions(args, str):
     return(tools_dict[str])
 
 
-def print_versions(args):
-    '''Print out versions of all the various tools needed'''
+def install_host_packages(args):
+    '''Install every package this run needs in one transaction
 
-    banner('Kubernetes - Bring up a Kubernetes Cluster:')
-    if args.edit_globals:
-        print('  *globals.yaml will be editable with this option*\n')
+    Repositories are set up first. Then the package metadata is refreshed
+    once, and the PACKAGES phases this run needs are resolved and installed
+    together. Docker is always needed, the rest only when this host is
+    being set up for kubernetes.
+    '''
 
-    if args.edit_cloud:
-        print('  *cloud.yaml will be editable with this option*\n')
+    if args.openstack:
+        phases = ['docker']
+    else:
+        phases = ['docker', 'tools', 'ntp', 'kubernetes']
+        k8s_create_repo(args)
 
-    # This a good place to install docker - as it's always needed and we
-    # need the version anyway
+    linux = linux_ver()
+    packages = []
+    for phase in phases:
+        for package in PACKAGES[linux][phase]:
+            packages.append(
+                package % {'k8s': tools_versions(args, 'kubernetes')})
 
     # Note later versions of ubuntu require a change:
     # https://github.com/moby/moby/issues/15651
@@ -513,11 +1013,32 @@ def print_versions(args):
     # sudo systemctl daemon-reload
     # sudo systemctl restart docker
     # sudo docker info
-    if linux_ver() == 'centos':
-        run_shell(args, 'sudo yum install -y docker')
+    if linux == 'centos':
+        # EPEL provides pip, jq and ansible so it is a repository to set up
+        # rather than part of the transaction
+        if 'tools' in phases:
+            run_shell(args, 'sudo yum install -y epel-release')
+            run_shell(args, 'sudo yum upgrade -y')
+        run_shell(args, 'sudo yum install -y %s' % ' '.join(packages))
     else:
         run_shell(args, 'sudo apt autoremove -y && sudo apt autoclean')
-        run_shell(args, 'sudo apt-get install -y docker.io')
+        run_shell(args, 'sudo apt-get update')
+        if 'tools' in phases:
+            run_shell(args, 'sudo apt-get dist-upgrade -y '
+                      '--allow-downgrades --no-install-recommends')
+        run_shell(args, 'sudo apt-get install -y --allow-downgrades %s'
+                  % ' '.join(packages))
+
+
+def print_versions(args):
+    '''Print out versions of all the various tools needed'''
+
+    banner('Kubernetes - Bring up a Kubernetes Cluster:')
+    if args.edit_globals:
+        print('  *globals.yaml will be editable with this option*\n')
+
+    if args.edit_cloud:
+        print('  *cloud.yaml will be editable with this option*\n')
 
     print('\nLinux Host Info:    %s' % linux_ver_det())
 
@@ -561,11 +1082,6 @@ def populate_ip_addresses(args):
     the users system
     '''
 
-    if linux_ver() == 'centos':
-        run_shell(args, 'sudo yum install -y nmap')
-    else:
-        run_shell(args, 'sudo apt-get install -y nmap')
-
     # Populate Management IP Address
     if args.mgmt_ip is 'None':
         mgt = run_shell(
@@ -577,17 +1093,410 @@ def populate_ip_addresses(args):
             print('    *Kubernetes - No IP Address found on %s*')
             sys.exit(1)
 
-    # Populate VIP IP Address - by finding an unused IP on MGMT subnet
+    # Populate VIP IP Address - by finding an unused IP on MGMT subnet,
+    # reusing the one reserved by a previous run if it is still free
+    start_ip = args.mgmt_ip[:args.mgmt_ip.rfind(".")]
     if args.vip_ip is 'None':
-        start_ip = args.mgmt_ip[:args.mgmt_ip.rfind(".")]
-
-        r = list(range(2, 253))
-        random.shuffle(r)
-        for k in r:
-            vip = run_shell(args, 'sudo nmap -sP -PR %s.%s' % (start_ip, k))
-            if "Host seems down" in vip:
-                args.vip_ip = start_ip + '.' + str(k)
-                break
+        vip = net_allocate_ips(args, args.MGMT_INT, start_ip, 'vip')
+        if vip:
+            args.vip_ip = vip[0]
+    else:
+        net_reserve_ips(args, args.MGMT_INT, start_ip, 'vip', [args.vip_ip])
+
+
+def net_get_mtu(iface):
+    '''Return the MTU of an interface, 1500 if it can not be read'''
+
+    try:
+        with open('/sys/class/net/%s/mtu' % iface) as f:
+            return(int(f.read()))
+    except (IOError, ValueError):
+        return(1500)
+
+
+def net_get_if_addr(iface):
+    '''Return the MAC and IPv4 addresses of an interface
+
+    The IPv4 address is "0.0.0.0" if the interface has none, like the
+    neutron interface.
+    '''
+
+    SIOCGIFADDR = 0x8915
+    SIOCGIFHWADDR = 0x8927
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        ifreq = struct.pack('256s', iface[:15].encode())
+        mac = fcntl.ioctl(s.fileno(), SIOCGIFHWADDR, ifreq)[18:24]
+        try:
+            ip = socket.inet_ntoa(
+                fcntl.ioctl(s.fileno(), SIOCGIFADDR, ifreq)[20:24])
+        except IOError:
+            ip = '0.0.0.0'
+    finally:
+        s.close()
+    return(mac, ip)
+
+
+def arp_probe(iface, ips, timeout=0.5, retries=2, window=256):
+    '''ARP ping a list of addresses on an interface
+
+    Send ARP who-has requests over a raw packet socket with up to window
+    probes in flight, each resent after timeout seconds up to retries times.
+    An interface with no address sends ARP probes (sender 0.0.0.0) which
+    hosts answer all the same.
+
+    Return a dictionary of ip to ProbeResult
+    '''
+
+    ETH_P_ARP = 0x0806
+    mac, src_ip = net_get_if_addr(iface)
+
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                         socket.htons(ETH_P_ARP))
+    sock.bind((iface, 0))
+
+    def send(ip):
+        frame = struct.pack('!6s6sH', b'\xff' * 6, mac, ETH_P_ARP)
+        frame += struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 1,
+                             mac, socket.inet_aton(src_ip),
+                             b'\x00' * 6, socket.inet_aton(ip))
+        sock.send(frame)
+
+    queue = list(ips)
+    in_flight = {}
+    results = {}
+    try:
+        while queue or in_flight:
+            now = time.time()
+            while queue and len(in_flight) < window:
+                ip = queue.pop(0)
+                send(ip)
+                in_flight[ip] = (now, 1, now)
+
+            for ip, (sent, tries, first) in list(in_flight.items()):
+                if now - sent < timeout:
+                    continue
+                if tries < retries:
+                    send(ip)
+                    in_flight[ip] = (now, tries + 1, first)
+                else:
+                    del in_flight[ip]
+                    results[ip] = ProbeResult(ip, False, 'arp', None, None)
+
+            if not select.select([sock], [], [], 0.01)[0]:
+                continue
+            frame = sock.recv(2048)
+            if len(frame) < 42:
+                continue
+            op, sha, spa = struct.unpack('!6xH6s4s', frame[14:32])
+            ip = socket.inet_ntoa(spa)
+            if op == 2 and ip in in_flight:
+                rtt = time.time() - in_flight.pop(ip)[2]
+                hw = ':'.join('%02x' % b for b in bytearray(sha))
+                results[ip] = ProbeResult(ip, True, 'arp', hw, rtt)
+    finally:
+        sock.close()
+    return(results)
+
+
+def icmp_checksum(data):
+    '''Return the internet checksum of data'''
+
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return(~total & 0xffff)
+
+
+def icmp_probe(ips, timeout=0.5, retries=2, window=256):
+    '''ICMP echo a list of addresses
+
+    Use an unprivileged ICMP socket where the kernel allows one, otherwise a
+    raw socket. The probing works like arp_probe.
+
+    Return a dictionary of ip to ProbeResult
+    '''
+
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_ICMP)
+        raw = False
+    except socket.error:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                             socket.getprotobyname('icmp'))
+        raw = True
+
+    ident = os.getpid() & 0xffff
+
+    def send(ip, seq):
+        header = struct.pack('!BBHHH', 8, 0, 0, ident, seq)
+        payload = b'ko.py probe'
+        header = struct.pack('!BBHHH', 8, 0,
+                             icmp_checksum(header + payload), ident, seq)
+        sock.sendto(header + payload, (ip, 0))
+
+    queue = list(ips)
+    in_flight = {}
+    results = {}
+    try:
+        while queue or in_flight:
+            now = time.time()
+            while queue and len(in_flight) < window:
+                ip = queue.pop(0)
+                send(ip, 1)
+                in_flight[ip] = (now, 1, now)
+
+            for ip, (sent, tries, first) in list(in_flight.items()):
+                if now - sent < timeout:
+                    continue
+                if tries < retries:
+                    send(ip, tries + 1)
+                    in_flight[ip] = (now, tries + 1, first)
+                else:
+                    del in_flight[ip]
+                    results[ip] = ProbeResult(ip, False, 'icmp', None, None)
+
+            if not select.select([sock], [], [], 0.01)[0]:
+                continue
+            packet, addr = sock.recvfrom(2048)
+            if raw:
+                ihl = struct.unpack('!B', packet[:1])[0] & 0xf
+                packet = packet[ihl * 4:]
+            ip = addr[0]
+            if packet[:1] == b'\x00' and ip in in_flight:
+                rtt = time.time() - in_flight.pop(ip)[2]
+                results[ip] = ProbeResult(ip, True, 'icmp', None, rtt)
+    finally:
+        sock.close()
+    return(results)
+
+
+def net_probe_local(iface, ips, timeout=0.5):
+    '''Probe addresses from this process
+
+    ARP is tried first as it finds hosts that drop pings, ICMP is the
+    fallback if a packet socket can not be opened on the interface.
+
+    Return a dictionary of ip to ProbeResult
+    '''
+
+    try:
+        return(arp_probe(iface, ips, timeout))
+    except (socket.error, IOError) as e:
+        logger.debug('ARP probe on %s failed (%s), using ICMP' % (iface, e))
+    print('  *WARNING: Can not ARP probe on %s, falling back to ICMP. Hosts '
+          'that drop pings are reported free and may be handed out, check '
+          'the vip address is unused*' % iface)
+    return(icmp_probe(ips, timeout))
+
+
+def sudo_call(func, *params):
+    '''Call a function of this script in a sudo'd copy of it
+
+    For the functions that need root, like opening packet sockets, which
+    needs CAP_NET_RAW. The parameters and the result go as JSON. Lines the
+    function prints are passed on once.
+
+    Return the result, None if the helper failed
+    '''
+
+    try:
+        p = subprocess.Popen(['sudo', '-n', sys.executable, '-B', '-c',
+                              SUDO_HELPER, os.path.abspath(__file__), func,
+                              json.dumps(params)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        logger.debug('Can not run the sudo helper: %s' % e)
+        return(None)
+    out, err = p.communicate()
+    lines = out.decode('utf-8', 'replace').splitlines()
+    if p.returncode != 0 or not lines:
+        logger.debug('sudo helper for %s failed (%s): %s' %
+                     (func, p.returncode, err.strip()))
+        return(None)
+
+    # The function's messages come before its result
+    for line in lines[:-1]:
+        if line not in NET_WARNINGS:
+            NET_WARNINGS.add(line)
+            print(line)
+    return(json.loads(lines[-1]))
+
+
+def net_probe_sudo(iface, ips, timeout=0.5):
+    '''Run net_probe_local through sudo_call
+
+    Return a dictionary of ip to ProbeResult, None if the helper failed
+    '''
+
+    results = sudo_call('net_probe_local', iface, list(ips), timeout)
+    if results is None:
+        return(None)
+    return(dict((ip, ProbeResult(*r)) for ip, r in results.items()))
+
+
+def net_probe(iface, ips, timeout=0.5):
+    '''Probe which of a list of addresses are in use
+
+    Root probes in-process, anyone else through net_probe_sudo, falling
+    back to probing in-process with whatever the kernel allows. A probe
+    never raises: if no probe can be sent every address is reported free,
+    loudly.
+
+    Return a dictionary of ip to ProbeResult
+    '''
+
+    if os.geteuid() != 0:
+        results = net_probe_sudo(iface, ips, timeout)
+        if results is not None:
+            return(results)
+    try:
+        return(net_probe_local(iface, ips, timeout))
+    except (socket.error, IOError) as e:
+        print('  *WARNING: Can not probe addresses on %s (%s), assuming they '
+              'are free. Pass a known unused --vip_ip*' % (iface, e))
+    return(dict((ip, ProbeResult(ip, False, 'none', None, None))
+                for ip in ips))
+
+
+def net_sweep_subnet(args, subnet, iface):
+    '''Return the set of free last octets (2-252) on a /24 subnet
+
+    The whole subnet is probed concurrently from iface, so the sweep costs
+    a few ARP timeouts rather than one per address. The result is
+    remembered so a subnet is only swept once per run.
+    '''
+
+    if subnet in SUBNET_SWEEPS:
+        return(SUBNET_SWEEPS[subnet])
+
+    ips = ['%s.%s' % (subnet, k) for k in range(2, 253)]
+    results = net_probe(iface, ips)
+    up = set(int(r.ip.split('.')[3]) for r in results.values() if r.alive)
+
+    # Our own address does not answer its own probes
+    own_ip = net_get_if_addr(iface)[1]
+    if own_ip.startswith(subnet + '.'):
+        up.add(int(own_ip.split('.')[3]))
+
+    SUBNET_SWEEPS[subnet] = set(range(2, 253)) - up
+    logger.debug('Swept %s.0/24: %d hosts up, %d addresses free' %
+                 (subnet, len(up), len(SUBNET_SWEEPS[subnet])))
+    return(SUBNET_SWEEPS[subnet])
+
+
+def net_find_free_ips(args, subnet, iface, count=1, exclude=()):
+    '''Find count consecutive free addresses on a /24 subnet
+
+    Pick a random run of candidates from the subnet sweep, skipping the
+    last octets in exclude, and re-verify only those, in case they came up
+    since the sweep. A picked address is never handed out twice in the same
+    run.
+
+    Return the list of ip addresses, empty if none could be found
+    '''
+
+    free = net_sweep_subnet(args, subnet, iface)
+    usable = free - set(exclude)
+    starts = [k for k in usable
+              if all(k + i in usable for i in range(count))]
+    random.shuffle(starts)
+    for k in starts:
+        octets = list(range(k, k + count))
+        if not all(o in free for o in octets):
+            continue
+        for o in octets:
+            free.discard(o)
+        ips = ['%s.%s' % (subnet, o) for o in octets]
+        results = net_probe(iface, ips)
+        if not any(results[ip].alive for ip in ips):
+            return(ips)
+
+    print('  *No %d free address(es) found on subnet %s.0/24*' %
+          (count, subnet))
+    return([])
+
+
+def ipam_load(args):
+    '''Load the network facts and ip reservations kept across runs'''
+
+    path = os.path.join(ko_cache_dir(args, 'network'), 'ipam.json')
+    ipam = load_json(path, {})
+    ipam.setdefault('facts', {})
+    ipam.setdefault('reservations', {})
+    return(ipam)
+
+
+def ipam_save(args, ipam):
+    '''Save the network facts and ip reservations'''
+
+    save_json(os.path.join(ko_cache_dir(args, 'network'), 'ipam.json'), ipam)
+
+
+def net_get_fact(args, iface, name):
+    '''Return a network fact remembered for an interface, or None'''
+
+    return(ipam_load(args)['facts'].get(iface, {}).get(name))
+
+
+def net_set_fact(args, iface, name, value):
+    '''Remember a network fact for an interface'''
+
+    ipam = ipam_load(args)
+    ipam['facts'].setdefault(iface, {})[name] = value
+    ipam_save(args, ipam)
+
+
+def net_reserve_ips(args, iface, subnet, purpose, ips):
+    '''Record ips as reserved for purpose on a /24 subnet'''
+
+    ipam = ipam_load(args)
+    pool = ipam['reservations'].setdefault('%s/%s.0/24' % (iface, subnet), {})
+    pool[purpose] = ips
+    ipam_save(args, ipam)
+
+
+def net_allocate_ips(args, iface, subnet, purpose, count=1):
+    '''Allocate count consecutive free addresses on a /24 subnet
+
+    Reservations are kept on disk per interface and subnet. A purpose that
+    already holds a reservation from a previous run gets it back after
+    re-checking only those addresses, without sweeping the subnet. New
+    allocations never overlap the addresses reserved for other purposes
+    on the same subnet, from any interface.
+
+    Return the list of ip addresses, empty if none could be found
+    '''
+
+    reservations = ipam_load(args)['reservations']
+    pool = reservations.get('%s/%s.0/24' % (iface, subnet), {})
+
+    ips = pool.get(purpose, [])
+    if len(ips) == count:
+        results = net_probe(iface, ips)
+        if not any(results[ip].alive for ip in ips):
+            logger.debug('Reusing %s reservation %s' % (purpose, ips))
+            return(ips)
+        print('  *Reserved %s address(es) %s are in use, finding others*' %
+              (purpose, ', '.join(ips)))
+
+    # Interfaces can share a subnet, like MGMT_INT and NEUTRON_INT on
+    # the same /24, so skip what any interface reserved on it
+    taken = set()
+    for key, other in reservations.items():
+        if not key.endswith('/%s.0/24' % subnet):
+            continue
+        for p, reserved in other.items():
+            if other is not pool or p != purpose:
+                taken.update(int(ip.split('.')[3]) for ip in reserved)
+
+    ips = net_find_free_ips(args, subnet, iface, count, taken)
+    if ips:
+        net_reserve_ips(args, iface, subnet, purpose, ips)
+    return(ips)
 
 
 def k8s_create_repo(args):
@@ -610,10 +1519,8 @@ gpgkey=https://packages.cloud.google.com/yum/doc/yum-key.gpg
         # todo: add -H to all sudo's see if it works in both envs
         run_shell(args, 'sudo mv ./kubernetes.repo %s' % repo)
     else:
-        run_shell(args,
-                  'curl -s https://packages.cloud.google.com'
-                  '/apt/doc/apt-key.gpg '
-                  '| sudo -E apt-key add -')
+        fetch_artifact(args, K8S_APT_KEY_URL, '/tmp/apt-key.gpg')
+        run_shell(args, 'sudo -E apt-key add /tmp/apt-key.gpg')
         name = './kubernetes.list'
         repo = '/etc/apt/sources.list.d/kubernetes.list'
         with open(name, "w") as w:
@@ -621,7 +1528,6 @@ gpgkey=https://packages.cloud.google.com/yum/doc/yum-key.gpg
 deb http://apt.kubernetes.io/ kubernetes-xenial main
 """)
         run_shell(args, 'sudo mv ./kubernetes.list %s' % repo)
-        run_shell(args, 'sudo apt-get update')
 
 
 def k8s_wait_for_kube_system(args):
@@ -698,6 +1604,28 @@ def k8s_wait_for_pod_start(args, chart):
             break
 
 
+def k8s_wait_for_chart_running(args, chart, timeout=600):
+    '''Wait for the kolla pods of a chart to be Running and ready'''
+
+    RETRY_INTERVAL = 3
+
+    start = time.time()
+    while True:
+        out = run_shell(args, 'kubectl get pods --no-headers -n kolla')
+        if not isinstance(out, str):
+            out = out.decode()
+        pods = [pod for pod in (line.split() for line in out.splitlines())
+                if pod and chart in pod[0]]
+        if pods and all(len(pod) > 2 and pod[2] == 'Running' and
+                        len(set(pod[1].split('/'))) == 1 for pod in pods):
+            print('  *Kubernetes - chart "%s" is running*' % chart)
+            return
+        if time.time() - start > timeout:
+            raise AbortScriptException('Pods of %s not running after %ds' %
+                                       (chart, timeout))
+        time.sleep(RETRY_INTERVAL)
+
+
 def k8s_wait_for_running_negate(args, timeout=None):
     '''Query get pods until only state is Running'''
 
@@ -778,6 +1706,79 @@ def k8s_wait_for_vm(args, vm):
             break
 
 
+def kolla_get_service_endpoints(args):
+    '''Return a dictionary of kolla service name to "ip:port"'''
+
+    endpoints = {}
+    out = run_shell(args,
+                    "kubectl get svc -n kolla -o jsonpath='"
+                    "{range .items[*]}{.metadata.name} {.spec.clusterIP} "
+                    "{.spec.ports[0].port}{\"\\n\"}{end}'")
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            endpoints[fields[0]] = '%s:%s' % (fields[1], fields[2])
+    return(endpoints)
+
+
+def probe_api(url):
+    '''Probe an API url once
+
+    Any HTTP answer below 500 means the API is serving, even a 300 or 401.
+    Return a tuple of (serving, latency in seconds)
+    '''
+
+    start = time.time()
+    try:
+        urlopen(url, timeout=5).close()
+        serving = True
+    except HTTPError as e:
+        serving = e.code < 500
+    except (URLError, IOError, OSError):
+        serving = False
+    return(serving, time.time() - start)
+
+
+def kolla_wait_for_apis(args, api_list, timeout=600):
+    '''Wait until the OpenStack APIs in api_list answer
+
+    "All pods Running" does not mean keystone or nova-api are serving, so
+    probe the actual endpoints behind the kolla services, all at once, until
+    each one answers. Report how long each took and its probe latency.
+    '''
+
+    RETRY_INTERVAL = 2
+
+    print('  Wait for OpenStack APIs %s to answer:' % ', '.join(api_list))
+
+    pending = list(api_list)
+    pool = ThreadPool(len(pending))
+    start = time.time()
+    while pending:
+        endpoints = kolla_get_service_endpoints(args)
+        urls = {}
+        for api in pending:
+            service, path = OPENSTACK_APIS[api]
+            if service in endpoints:
+                urls[api] = 'http://%s%s' % (endpoints[service], path)
+
+        apis = list(urls)
+        results = pool.map(probe_api, [urls[api] for api in apis])
+        for api, (serving, latency) in zip(apis, results):
+            if serving:
+                print('    *%s API is serving after %ds (%dms probe)*'
+                      % (api, time.time() - start, latency * 1000))
+                pending.remove(api)
+
+        if pending and time.time() - start > timeout:
+            print('    *Warning: %s API(s) not serving after %ds. '
+                  'YMMV continuing*' % (', '.join(pending), timeout))
+            break
+        elif pending:
+            time.sleep(RETRY_INTERVAL)
+    pool.close()
+
+
 def add_one_to_progress():
     '''Add one to progress meter'''
 
@@ -801,6 +1802,57 @@ def print_progress(process, msg, finalctr, add_one=False):
     add_one_to_progress()
 
 
+def pip_wheelhouse_install(args, requirements, sources=()):
+    '''Install python requirements from a cached wheelhouse
+
+    Wheels for the requirements and all their dependencies are built once
+    into a wheelhouse keyed by the requirement list and the git state of
+    the local source directories, then everything is installed in one
+    resolver pass from local wheels only.
+
+    sources are directories of python projects, given as requirements by
+    directory and installed by project name from the wheelhouse
+    '''
+
+    key = hashlib.sha256()
+    for requirement in sorted(requirements):
+        key.update(requirement.encode())
+    for source in sources:
+        key.update(run_shell(args,
+                             'cd %s && git rev-parse HEAD && git diff HEAD' %
+                             source))
+    wheelhouse = os.path.join(ko_cache_dir(args, 'wheelhouse'),
+                              key.hexdigest())
+    marker = os.path.join(wheelhouse, '.complete')
+
+    if not os.path.exists(marker):
+        if args.offline:
+            raise AbortScriptException(
+                'Offline - no wheelhouse for %s' %
+                ' '.join(requirements + list(sources)))
+        run_shell(args, 'sudo rm -rf %s' % wheelhouse)
+        packages = ' '.join(requirements + ['%s/' % d for d in sources])
+        rc, out, err = run_shell_status(
+            args, 'sudo -H pip wheel -w %s %s' % (wheelhouse, packages))
+        run_shell(args, 'sudo chown -R %s %s' % (os.getuid(), wheelhouse))
+        if rc != 0:
+            # Not marked complete, so the next run builds it again
+            err = err or out
+            if not isinstance(err, str):
+                err = err.decode('utf-8', 'replace')
+            print('  *Building the wheelhouse failed, installing from the '
+                  'package index:\n%s*' % '\n'.join(err.splitlines()[-3:]))
+            run_shell(args, 'sudo -H pip install -U %s' % packages)
+            return
+        open(marker, 'w').close()
+    else:
+        print('  *Installing python packages from cached wheelhouse*')
+
+    names = [os.path.basename(d.rstrip('/')) for d in sources]
+    run_shell(args, 'sudo -H pip install -U --no-index --find-links %s %s' %
+              (wheelhouse, ' '.join(requirements + names)))
+
+
 def k8s_install_tools(args):
     '''Basic tools needed for first pass'''
 
@@ -810,41 +1862,11 @@ def k8s_install_tools(args):
 
     print_progress('Kubernetes', 'Installing base tools', K8S_FINAL_PROGRESS)
 
-    if linux_ver() == 'centos':
-        run_shell(args, 'sudo yum update -y; sudo yum upgrade -y')
-        run_shell(args, 'sudo yum install -y qemu epel-release bridge-utils')
-        run_shell(args,
-                  'sudo yum install -y python-pip python-devel libffi-devel '
-                  'gcc openssl-devel sshpass')
-        run_shell(args, 'sudo yum install -y git crudini jq ansible curl lvm2')
-    else:
-        run_shell(args, 'sudo apt-get update; sudo apt-get dist-upgrade -y '
-                  '--allow-downgrades --no-install-recommends')
-        run_shell(args, 'sudo apt-get install -y qemu bridge-utils')
-        run_shell(args, 'sudo apt-get install -y python-dev libffi-dev gcc '
-                  'libssl-dev python-pip sshpass')
-        # 'libssl-dev python-pip sshpass apt-transport-https')
-        run_shell(args, 'sudo apt-get install -y git gcc crudini jq '
-                  'ansible curl lvm2')
-
-    curl(
-        '-L',
-        'https://bootstrap.pypa.io/get-pip.py',
-        '-o', '/tmp/get-pip.py')
+    # The distro packages were installed by install_host_packages
+    fetch_artifact(args, GET_PIP_URL, '/tmp/get-pip.py')
     run_shell(args, 'sudo python /tmp/get-pip.py')
 
-    run_shell(args,
-              'sudo -H pip install ansible==%s' %
-              tools_versions(args, 'ansible'))
-
-    # Standard jinja2 in Centos7(2.9.6) is broken
-    run_shell(args,
-              'sudo -H pip install Jinja2==%s' %
-              tools_versions(args, 'jinja2'))
-
-    # https://github.com/ansible/ansible/issues/26670
-    run_shell(args, 'sudo -H pip uninstall pyOpenSSL -y')
-    run_shell(args, 'sudo -H pip install pyOpenSSL')
+    # The python packages are installed by kolla_install_repos
 
 
 def k8s_setup_ntp(args):
@@ -852,11 +1874,9 @@ def k8s_setup_ntp(args):
 
     print_progress('Kubernetes', 'Setup NTP', K8S_FINAL_PROGRESS)
     if linux_ver() == 'centos':
-        run_shell(args, 'sudo yum install -y ntp')
         run_shell(args, 'sudo systemctl enable ntpd.service')
         run_shell(args, 'sudo systemctl start ntpd.service')
     else:
-        run_shell(args, 'sudo apt-get install -y ntp')
         run_shell(args, 'sudo systemctl restart ntp')
 
 
@@ -893,30 +1913,72 @@ def k8s_install_k8s(args):
                    'Creating Kubernetes repo, installing Kubernetes '
                    'packages', K8S_FINAL_PROGRESS)
 
-    run_shell(args, 'sudo -H pip install --upgrade pip')
-    k8s_create_repo(args)
-
-    demo(args, 'Installing Kubernetes', 'Installing docker ebtables '
+    # The repo and packages were set up by install_host_packages
+    demo(args, 'Installing Kubernetes', 'Installed docker ebtables '
          'kubelet-%s kubeadm-%s kubectl-%s kubernetes-cni' %
          (tools_versions(args, 'kubernetes'),
           tools_versions(args, 'kubernetes'),
           tools_versions(args, 'kubernetes')))
 
-    if linux_ver() == 'centos':
-        run_shell(args,
-                  'sudo yum install -y ebtables kubelet-%s '
-                  'kubeadm-%s kubectl-%s kubernetes-cni'
-                  % (tools_versions(args, 'kubernetes'),
-                     tools_versions(args, 'kubernetes'),
-                     tools_versions(args, 'kubernetes')))
+
+def docker_registry_mirror(args):
+    '''The host:port of the registry mirror'''
+
+    if args.registry_mirror == 'local':
+        return('%s:%s' % (args.mgmt_ip, REGISTRY_MIRROR_PORT))
+    return(args.registry_mirror)
+
+
+def docker_setup_registry_mirror(args):
+    '''Pull docker images through a registry mirror
+
+    With "local" a pull-through registry of Docker Hub runs on this host,
+    storing layers in the cache so they survive cleanups. It is reused if
+    it is already running. Other nodes give its host:port so every layer
+    is pulled from the WAN only once. The docker daemon is configured to
+    use the mirror and restarted if its config changed.
+    '''
+
+    if args.registry_mirror == 'None':
+        return
+
+    print_progress('Kubernetes', 'Setup docker registry mirror',
+                   K8S_FINAL_PROGRESS)
+    mirror = docker_registry_mirror(args)
+
+    daemon = '/etc/docker/daemon.json'
+    config = {}
+    if os.path.exists(daemon):
+        config = json.loads(run_shell(args, 'sudo cat %s' % daemon) or '{}')
+    new = dict(config)
+    new['registry-mirrors'] = ['http://%s' % mirror]
+    new['insecure-registries'] = sorted(
+        set(config.get('insecure-registries', []) + [mirror]))
+    if new != config:
+        save_json('/tmp/daemon.json', new)
+        run_shell(args, 'sudo mkdir -p /etc/docker')
+        run_shell(args, 'sudo mv /tmp/daemon.json %s' % daemon)
+        run_shell(args, 'sudo systemctl restart docker')
+    run_shell(args, 'sudo systemctl enable docker')
+    run_shell(args, 'sudo systemctl start docker')
+
+    if args.registry_mirror != 'local':
+        print('  Using registry mirror %s' % mirror)
+        return
+
+    if run_shell(args, 'sudo docker ps -q -f name=ko-registry'):
+        print('  Reusing registry mirror %s' % mirror)
+        return
+    if run_shell(args, 'sudo docker ps -a -q -f name=ko-registry'):
+        run_shell(args, 'sudo docker start ko-registry')
     else:
-        # todo - this breaks when ubuntu steps up a revision to -01 etc
         run_shell(args,
-                  'sudo apt-get install -y --allow-downgrades '
-                  'ebtables kubelet=%s-00 kubeadm=%s-00 kubectl=%s-00 '
-                  'kubernetes-cni' % (tools_versions(args, 'kubernetes'),
-                                      tools_versions(args, 'kubernetes'),
-                                      tools_versions(args, 'kubernetes')))
+                  'sudo docker run -d --restart=always --name ko-registry '
+                  '-p %s:5000 -v %s:/var/lib/registry '
+                  '-e REGISTRY_PROXY_REMOTEURL=https://registry-1.docker.io '
+                  'registry:2' %
+                  (REGISTRY_MIRROR_PORT, ko_cache_dir(args, 'registry')))
+    print('  Started registry mirror %s' % mirror)
 
 
 def k8s_setup_dns(args):
@@ -1003,6 +2065,45 @@ def k8s_fix_iptables(args):
         run_shell(args, 'sudo sysctl -p')
 
 
+def k8s_control_plane_images(args):
+    '''List the control plane images kubeadm init will run'''
+
+    version = tools_versions(args, 'kubernetes')
+    out = run_shell(args, 'kubeadm config images list '
+                    '--kubernetes-version v%s 2>/dev/null' % version)
+    if not isinstance(out, str):
+        out = out.decode()
+    images = [line for line in out.split() if '/' in line]
+    if images:
+        return(images)
+
+    minor = '.'.join(version.split('.')[:2])
+    etcd, dns = KUBEADM_IMAGES.get(minor, KUBEADM_IMAGES['1.8'])
+    repo = 'gcr.io/google_containers'
+    images = ['%s/%s-amd64:v%s' % (repo, name, version) for name in
+              ['kube-apiserver', 'kube-controller-manager', 'kube-scheduler',
+               'kube-proxy']]
+    images.append('%s/etcd-amd64:%s' % (repo, etcd))
+    images.extend(['%s/k8s-dns-%s-amd64:%s' % (repo, name, dns) for name in
+                   ['kube-dns', 'dnsmasq-nanny', 'sidecar']])
+    images.append('%s/pause-amd64:3.0' % repo)
+    return(images)
+
+
+def k8s_prepull_images(args):
+    '''Start pulling the control plane images in the background
+
+    So they download while NTP, the firewall, DNS and kubelet are set up
+    and kubeadm init only starts containers
+    '''
+
+    print_progress('Kubernetes', 'Pre-pull control plane images',
+                   K8S_FINAL_PROGRESS)
+    run_shell(args, 'sudo systemctl start docker')
+    PREFETCHES['kubeadm-images'] = docker_pull_images(
+        args, k8s_control_plane_images(args), args.pull_concurrency)
+
+
 def k8s_deploy_k8s(args):
     '''Start the kubernetes master'''
 
@@ -1041,6 +2142,10 @@ def k8s_deploy_k8s(args):
          'Kubelet is running, and the\nKubelet makes sure our containers '
          'with the control plane components are running.')
 
+    # Wait for the images pulled in the background
+    if 'kubeadm-images' in PREFETCHES:
+        docker_report_pulls(PREFETCHES['kubeadm-images'].get())
+
     if args.demo:
         print(run_shell(args,
                         'sudo kubeadm init --pod-network-cidr=10.1.0.0/16 '
@@ -1162,18 +2267,22 @@ def k8s_deploy_cni(args):
             K8S_FINAL_PROGRESS)
         weave_ver = run_shell(args,
                               "echo $(kubectl version | base64 | tr -d '\n')")
-        curl(
-            '-L',
-            'https://cloud.weave.works/k8s/net?k8s-version=%s' % weave_ver,
-            '-o', '/tmp/weave.yaml')
-
-        # Don't allow Weave Net to crunch ip's used by k8s
+        fetch_artifact(args, WEAVE_URL % weave_ver, '/tmp/weave.yaml')
+
+        # Don't allow Weave Net to crunch ip's used by k8s, and size its MTU
+        # to the management interface
+        cni_mtu = net_get_mtu(args.MGMT_INT) - VXLAN_OVERHEAD
+        print('  CNI MTU: %d (%s MTU %d - %d VXLAN overhead)' %
+              (cni_mtu, args.MGMT_INT, cni_mtu + VXLAN_OVERHEAD,
+               VXLAN_OVERHEAD))
         name = '/tmp/ipalloc.txt'
         with open(name, "w") as w:
             w.write("""\
                 - name: IPALLOC_RANGE
                   value: 10.0.0.0/16
-""")
+                - name: WEAVE_MTU
+                  value: "%d"
+""" % cni_mtu)
         run_shell(args, 'chmod 777 /tmp/ipalloc.txt /tmp/weave.yaml')
         run_shell(args, "sed -i '/fieldPath: spec.nodeName/ r "
                   "/tmp/ipalloc.txt' /tmp/weave.yaml")
@@ -1191,12 +2300,7 @@ def k8s_deploy_cni(args):
         'Kubernetes', 'Deploy pod network SDN using Canal CNI',
         K8S_FINAL_PROGRESS)
 
-    answer = curl(
-        '-L',
-        'https://raw.githubusercontent.com/projectcalico/canal/master/'
-        'k8s-install/1.7/rbac.yaml',
-        '-o', '/tmp/rbac.yaml')
-    logger.debug(answer)
+    fetch_artifact(args, CANAL_RBAC_URL, '/tmp/rbac.yaml')
     run_shell(args, 'kubectl create -f /tmp/rbac.yaml')
 
     if args.demo:
@@ -1221,28 +2325,54 @@ def k8s_deploy_cni(args):
              'operations, and with\n'
              'support for CNI is taking the next step toward a '
              'common ground for\nnetworking.')
-    answer = curl(
-        '-L',
-        'https://raw.githubusercontent.com/projectcalico/canal/master/'
-        'k8s-install/1.7/canal.yaml',
-        '-o', '/tmp/canal.yaml')
-    logger.debug(answer)
+    fetch_artifact(args, CANAL_URL, '/tmp/canal.yaml')
     run_shell(args, 'sudo chmod 777 /tmp/canal.yaml')
     run_shell(args,
               'sudo sed -i s@10.244.0.0/16@10.1.0.0/16@ /tmp/canal.yaml')
+    k8s_set_canal_mtu(args, '/tmp/canal.yaml')
     run_shell(args, 'kubectl create -f /tmp/canal.yaml')
     demo(args,
          'Wait for CNI to be deployed',
          'A successfully deployed CNI will result in a valid dns pod')
 
 
-def k8s_add_api_server(args):
-    '''Add API Server'''
+def k8s_set_canal_mtu(args, canal):
+    '''Size the canal pod network MTU to the management interface
 
-    print_progress('Kubernetes', 'Add API Server', K8S_FINAL_PROGRESS)
+    Flannel sizes its VXLAN device itself, but the calico CNI plugin
+    defaults the pod veths to 1500, which fragments on hosts whose own MTU
+    is already reduced, like VMs on an overlay.
+    '''
 
-    run_shell(args, 'sudo mkdir -p /etc/nodepool/')
-    run_shell(args, 'sudo echo %s > /tmp/primary_node_private' % args.mgmt_ip)
+    cni_mtu = net_get_mtu(args.MGMT_INT) - VXLAN_OVERHEAD
+
+    with open(canal) as f:
+        contents = f.read()
+    if re.search(r'veth_mtu:', contents):
+        contents, count = re.subn(r'veth_mtu: "?\d+"?',
+                                  'veth_mtu: "%d"' % cni_mtu, contents)
+    else:
+        contents, count = re.subn(
+            r'^(\s*)"type": "calico",$',
+            r'\1"type": "calico",\n\1"mtu": %d,' % cni_mtu,
+            contents, count=1, flags=re.M)
+    if not count:
+        print('  *WARNING: No veth_mtu or calico CNI config in %s, the CNI '
+              'MTU is left at its default*' % canal)
+        return
+    with open(canal, 'w') as w:
+        w.write(contents)
+    print('  CNI MTU: %d (%s MTU %d - %d VXLAN overhead)' %
+          (cni_mtu, args.MGMT_INT, cni_mtu + VXLAN_OVERHEAD, VXLAN_OVERHEAD))
+
+
+def k8s_add_api_server(args):
+    '''Add API Server'''
+
+    print_progress('Kubernetes', 'Add API Server', K8S_FINAL_PROGRESS)
+
+    run_shell(args, 'sudo mkdir -p /etc/nodepool/')
+    run_shell(args, 'sudo echo %s > /tmp/primary_node_private' % args.mgmt_ip)
     run_shell(args, 'sudo mv -f /tmp/primary_node_private /etc/nodepool')
 
 
@@ -1311,6 +2441,52 @@ subjects:
         run_shell(args, 'kubectl apply -f /tmp/rbac')
 
 
+def k8s_wait_for_tiller(args, timeout=300):
+    '''Wait for the Tiller pod to be ready
+
+    Watches the pod over one kubectl connection instead of polling, and
+    gives up at once if its image can not be pulled, or after timeout
+    seconds
+    '''
+
+    watch = subprocess.Popen(
+        'exec kubectl get pods -n kube-system -l app=helm,name=tiller -w '
+        '-o jsonpath=\'{.status.containerStatuses[0].ready} '
+        '{.status.containerStatuses[0].state.waiting.reason}{"\\n"}\'',
+        stdout=subprocess.PIPE, shell=True)
+    deadline = time.time() + timeout
+    pending = b''
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise AbortScriptException(
+                    'Tiller was not ready after %d seconds' % timeout)
+            ready, _, _ = select.select([watch.stdout], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(watch.stdout.fileno(), 4096)
+            if not chunk:
+                raise AbortScriptException('Watch of the Tiller pod ended')
+            pending += chunk
+            while b'\n' in pending:
+                line, pending = pending.split(b'\n', 1)
+                fields = line.decode().split()
+                if fields[:1] == ['true']:
+                    print('  *Tiller is ready*')
+                    return
+                reason = ' '.join(fields[1:])
+                if reason in ['ErrImagePull', 'ImagePullBackOff',
+                              'InvalidImageName']:
+                    raise AbortScriptException(
+                        'Tiller image can not be pulled: %s' % reason)
+                if reason:
+                    print('  *Tiller is %s*' % reason)
+    finally:
+        watch.kill()
+        watch.wait()
+
+
 def kolla_install_deploy_helm(args):
     '''Deploy helm binary'''
 
@@ -1319,30 +2495,21 @@ def kolla_install_deploy_helm(args):
 
     demo(args, 'Download the version of helm requested and install it',
          'Installing means the Tiller Server will be instantiated in a pod')
-    curl('-sSL',
-         'https://storage.googleapis.com/kubernetes-helm/'
-         'helm-v%s-linux-amd64.tar.gz' % args.helm_version,
-         '-o',
-         '/tmp/helm-v%s-linux-amd64.tar.gz' % args.helm_version)
+    fetch_artifact(args, HELM_URL % args.helm_version,
+                   '/tmp/helm-v%s-linux-amd64.tar.gz' % args.helm_version)
     untar('/tmp/helm-v%s-linux-amd64.tar.gz' % args.helm_version)
     run_shell(args, 'sudo mv -f linux-amd64/helm /usr/local/bin/helm')
     run_shell(args, 'helm init')
-    k8s_wait_for_pod_start(args, 'tiller')
-    k8s_wait_for_running_negate(args)
-    # Check for helm version
-    # Todo - replace this to using json path to check for that field
-    while True:
-        out = run_shell(args,
-                        'helm version | grep "%s" | wc -l' %
-                        args.helm_version)
-        if int(out) == 2:
-            print_progress(
-                'Kolla',
-                'Helm successfully installed', KOLLA_FINAL_PROGRESS)
-            break
-        else:
-            time.sleep(1)
-            continue
+    k8s_wait_for_tiller(args)
+
+    out = run_shell(args, 'helm version --short')
+    if not isinstance(out, str):
+        out = out.decode()
+    if out.count('v%s' % args.helm_version) != 2:
+        print('  *Helm client and server versions differ:*\n%s' % out)
+    print_progress(
+        'Kolla',
+        'Helm successfully installed', KOLLA_FINAL_PROGRESS)
 
     demo(args, 'Check running pods..',
          'Note that the helm version in server and client is the same.\n'
@@ -1412,9 +2579,13 @@ def k8s_cleanup(args):
                   "sudo docker volume rm -f $(sudo docker volume "
                   "ls -qf dangling=true)")
 
-        # Remove docker images on system
-        run_shell(args,
-                  "sudo docker rmi $(sudo docker images -a -q)")
+        if args.complete_cleanup:
+            # Remove docker images on system
+            run_shell(args,
+                      "sudo docker rmi $(sudo docker images -a -q)")
+        else:
+            # Remove docker images outside the retention policy
+            docker_gc_images(args)
 
         if args.complete_cleanup:
             print_progress('Kubernetes', 'Cleanup done. Highly '
@@ -1431,6 +2602,42 @@ def k8s_cleanup(args):
     run_shell(args, 'sudo kubeadm reset')
 
 
+def kolla_clone_repo(args, name):
+    '''Replace ./name with a checkout of a kolla repo at --git_ref
+
+    The checkout shares its objects with the cached mirror, so it is
+    local and cheap. The mirror was usually updated at startup.
+    '''
+
+    if os.path.exists('./%s' % name):
+        run_shell(args, 'sudo rm -rf ./%s' % name)
+
+    if name in PREFETCHES:
+        PREFETCHES[name].wait()
+        mirror = os.path.join(ko_cache_dir(args, 'git'), '%s.git' % name)
+        if not os.path.exists(mirror):
+            mirror = git_update_mirror(args, name)
+    else:
+        mirror = git_update_mirror(args, name)
+
+    run_shell(args, 'git clone -q --shared --no-checkout %s ./%s' %
+              (mirror, name))
+    run_shell(args, 'cd ./%s; git remote set-url origin %s; '
+              'git checkout -q -f %s' %
+              (name, KOLLA_REPOS[name], args.git_ref))
+    if not os.path.exists('./%s/setup.py' % name):
+        raise AbortScriptException(
+            'Could not check out %s at %s' % (name, args.git_ref))
+
+
+def kolla_ansible_examples():
+    '''Where pip installed the kolla-ansible example configuration'''
+
+    if linux_ver() == 'centos':
+        return('/usr/share/kolla-ansible/etc_examples')
+    return('/usr/local/share/kolla-ansible/etc_examples')
+
+
 def kolla_install_repos(args):
     '''Installing the kolla repos
 
@@ -1451,16 +2658,10 @@ def kolla_install_repos(args):
              'http://github.com/openstack/kolla-ansible\n'
              'http://github.com/openstack/kolla-kubernetes')
 
-        if os.path.exists('./kolla-ansible'):
-            run_shell(args, 'sudo rm -rf ./kolla-ansible')
-        run_shell(args,
-                  'git clone http://github.com/openstack/kolla-ansible')
+        kolla_clone_repo(args, 'kolla-ansible')
 
-        if os.path.exists('./kolla-kubernetes'):
-            run_shell(args, 'sudo rm -rf ./kolla-kubernetes')
         print_progress('Kolla', 'Clone kolla-kubernetes', KOLLA_FINAL_PROGRESS)
-        run_shell(args,
-                  'git clone http://github.com/openstack/kolla-kubernetes')
+        kolla_clone_repo(args, 'kolla-kubernetes')
 
         if args.dev_mode:
             pause_tool_execution('DEV: edit kolla-kubernetes repo now')
@@ -1488,22 +2689,25 @@ def kolla_install_repos(args):
 
     cinder_wip(args)
 
-    run_shell(args, 'sudo -H pip install -U kolla-ansible/ kolla-kubernetes/')
+    # https://github.com/ansible/ansible/issues/26670
+    run_shell(args, 'sudo -H pip uninstall pyOpenSSL -y')
 
-    if linux_ver() == 'centos':
-        print_progress('Kolla', 'Copy default kolla-ansible '
-                       'configuration to /etc',
-                       KOLLA_FINAL_PROGRESS)
-        run_shell(args,
-                  'sudo cp -aR /usr/share/kolla-ansible/etc_'
-                  'examples/kolla /etc')
-    else:
-        print_progress('Kolla', 'Copy default kolla-ansible '
-                       'configuration to /etc',
-                       KOLLA_FINAL_PROGRESS)
-        run_shell(args,
-                  'sudo cp -aR /usr/local/share/kolla-ansible/'
-                  'etc_examples/kolla /etc')
+    # Standard jinja2 in Centos7(2.9.6) is broken
+    pip_wheelhouse_install(
+        args,
+        ['ansible==%s' % tools_versions(args, 'ansible'),
+         'Jinja2==%s' % tools_versions(args, 'jinja2'),
+         'pyOpenSSL',
+         'python-openstackclient',
+         'python-neutronclient',
+         'python-cinderclient'],
+        ['kolla-ansible', 'kolla-kubernetes'])
+
+    print_progress('Kolla', 'Copy default kolla-ansible '
+                   'configuration to /etc',
+                   KOLLA_FINAL_PROGRESS)
+    run_shell(args, 'sudo cp -aR %s /etc' %
+              os.path.join(kolla_ansible_examples(), 'kolla'))
 
     print_progress('Kolla', 'Copy default kolla-kubernetes '
                    'configuration to /etc',
@@ -1557,9 +2761,8 @@ def kolla_install_os_client(args):
          'python-openstackclient, python-neutronclient and '
          'python-cinderclient\nprovide the command-line '
          'clients for openstack')
-    run_shell(args, 'sudo -H pip install python-openstackclient')
-    run_shell(args, 'sudo -H pip install python-neutronclient')
-    run_shell(args, 'sudo -H pip install python-cinderclient')
+
+    # The clients are installed from the wheelhouse by kolla_install_repos
 
 
 def kolla_gen_passwords(args):
@@ -1613,10 +2816,83 @@ def k8s_check_exit(k8s_only):
         sys.exit(1)
 
 
+def yaml_set_keys(lines, settings):
+    '''Set top level keys of a YAML file, given as a list of lines
+
+    Only keys at column 0, or commented out as #key:, are matched, keys
+    nested under a mapping are left alone. A key that is set is replaced
+    where it is, a commented out key is uncommented and a missing key is
+    appended. Each key ends up on one
+    line only, so applying the same settings again changes nothing.
+    settings is a list of (key, value) pairs, the values are written as
+    JSON which YAML reads back as the same value.
+    '''
+
+    values = dict(settings)
+    pattern = re.compile(r'^(#?)([A-Za-z0-9_]+):')
+
+    # Where each key goes: its first setting, else its first comment
+    place = {}
+    for i, line in enumerate(lines):
+        m = pattern.match(line)
+        if m and m.group(2) in values:
+            key = m.group(2)
+            if key not in place or \
+                    (not m.group(1) and lines[place[key]].startswith('#')):
+                place[key] = i
+
+    out = []
+    for i, line in enumerate(lines):
+        m = pattern.match(line)
+        if m and m.group(2) in values:
+            if place[m.group(2)] == i:
+                line = '%s: %s' % (m.group(2), json.dumps(values[m.group(2)]))
+            elif not m.group(1):
+                # A duplicate setting
+                continue
+        out.append(line)
+    for key, value in settings:
+        if key not in place:
+            out.append('%s: %s' % (key, json.dumps(value)))
+    return(out)
+
+
+def sudo_write(args, path, content):
+    '''Replace a root owned file in one atomic step
+
+    The new file is put next to path, owned by root, and renamed over it,
+    which is only atomic within one filesystem
+    '''
+
+    tmp = '/tmp/%s.ko' % os.path.basename(path)
+    with open(tmp, 'w') as w:
+        w.write(content)
+    new = os.path.join(os.path.dirname(path),
+                       '.%s.ko' % os.path.basename(path))
+    rc, out, err = run_shell_status(
+        args,
+        'sudo cp %s %s && sudo chown root:root %s && sudo chmod 644 %s && '
+        'sudo mv -f %s %s' % (tmp, new, new, new, new, path))
+    os.remove(tmp)
+    if rc != 0:
+        run_shell(args, 'sudo rm -f %s' % new)
+        raise AbortScriptException('Can not write %s: %s' % (path, err))
+
+
+def kolla_globals_model(args):
+    '''The settings of /etc/kolla/globals.yml, from the user's inputs'''
+
+    return([('network_interface', args.MGMT_INT),
+            ('kolla_internal_vip_address', args.mgmt_ip),
+            ('neutron_external_interface', args.NEUTRON_INT)] +
+           KOLLA_GLOBALS)
+
+
 def kolla_modify_globals(args):
     '''Necessary additions and changes to the global.yml.
 
-    Which is based on the users inputs
+    Which is based on the users inputs. The upstream globals.yml is
+    loaded, all settings are applied in memory and the file written once.
     '''
 
     print_progress('Kolla',
@@ -1631,75 +2907,12 @@ def kolla_modify_globals(args):
          % args.NEUTRON_INT +
          'globals.yml is used when we run ansible to generate '
          'configs in further step')
-    run_shell(args,
-              "sudo sed -i 's/eth0/%s/g' /etc/kolla/globals.yml"
-              % args.MGMT_INT)
-    run_shell(args,
-              "sudo sed -i 's/#network_interface/network_interface/g' "
-              "/etc/kolla/globals.yml")
-    run_shell(args,
-              "sudo sed -i 's/10.10.10.254/%s/g' /etc/kolla/globals.yml" %
-              args.mgmt_ip)
-    run_shell(args,
-              "sudo sed -i 's/eth1/%s/g' /etc/kolla/globals.yml"
-              % args.NEUTRON_INT)
-    run_shell(args,
-              "sudo sed -i 's/#neutron_external_interface/"
-              "neutron_external_interface/g' /etc/kolla/globals.yml")
-
 
-def kolla_add_to_globals(args):
-    '''Default section needed'''
-
-    print_progress(
-        'Kolla',
-        'Add default config to globals.yml',
-        KOLLA_FINAL_PROGRESS)
-
-    new = '/tmp/add'
-    add_to = '/etc/kolla/globals.yml'
-
-    with open(new, "w") as w:
-        w.write("""
-kolla_install_type: "source"
-tempest_image_alt_id: "{{ tempest_image_id }}"
-tempest_flavor_ref_alt_id: "{{ tempest_flavor_ref_id }}"
-
-neutron_plugin_agent: "openvswitch"
-api_interface_address: 0.0.0.0
-tunnel_interface_address: 0.0.0.0
-orchestration_engine: KUBERNETES
-memcached_servers: "memcached"
-keystone_admin_url: "http://keystone-admin:35357/v3"
-keystone_internal_url: "http://keystone-internal:5000/v3"
-keystone_public_url: "http://keystone-public:5000/v3"
-glance_registry_host: "glance-registry"
-neutron_host: "neutron"
-keystone_database_address: "mariadb"
-glance_database_address: "mariadb"
-nova_database_address: "mariadb"
-nova_api_database_address: "mariadb"
-neutron_database_address: "mariadb"
-cinder_database_address: "mariadb"
-ironic_database_address: "mariadb"
-placement_database_address: "mariadb"
-rabbitmq_servers: "rabbitmq"
-openstack_logging_debug: "True"
-enable_haproxy: "no"
-enable_heat: "no"
-enable_cinder: "yes"
-enable_cinder_backend_lvm: "yes"
-enable_cinder_backend_iscsi: "yes"
-enable_cinder_backend_rbd: "no"
-enable_ceph: "no"
-enable_elasticsearch: "no"
-enable_kibana: "no"
-glance_backend_ceph: "no"
-cinder_backend_ceph: "no"
-nova_backend_ceph: "no"
-enable_neutron_provider_networks: "yes"
-""")
-    run_shell(args, 'cat %s | sudo tee -a %s' % (new, add_to))
+    with open(os.path.join(kolla_ansible_examples(),
+                           'kolla/globals.yml')) as f:
+        lines = f.read().splitlines()
+    lines = yaml_set_keys(lines, kolla_globals_model(args))
+    sudo_write(args, '/etc/kolla/globals.yml', '\n'.join(lines) + '\n')
 
     if args.edit_globals:
         pause_tool_execution('Pausing to edit the /etc/kolla/globals.yml file')
@@ -1707,7 +2920,7 @@ enable_neutron_provider_networks: "yes"
     demo(args, 'We have also added some basic config that is not defaulted',
          'Mainly Cinder and Database:')
     if args.demo:
-        print(run_shell(args, 'sudo cat /tmp/add'))
+        print(run_shell(args, 'sudo cat /etc/kolla/globals.yml'))
 
 
 def kolla_enable_qemu(args):
@@ -1743,6 +2956,31 @@ def kolla_enable_qemu(args):
               'sudo apparmor_parser -R /etc/apparmor.d/usr.sbin.libvirtd')
 
 
+def kolla_set_neutron_mtu(args):
+    '''Set the neutron MTUs from the underlying interfaces
+
+    The external flat network uses the neutron interface MTU. Tenant VXLAN
+    networks are tunnelled over the management interface, so neutron
+    subtracts the VXLAN overhead from that path MTU.
+    '''
+
+    physnet_mtu = net_get_mtu(args.NEUTRON_INT)
+    path_mtu = net_get_mtu(args.MGMT_INT)
+
+    print_progress('Kolla',
+                   'Set Neutron MTUs: physnet %d, tenant VXLAN %d' %
+                   (physnet_mtu, path_mtu - VXLAN_OVERHEAD),
+                   KOLLA_FINAL_PROGRESS)
+
+    run_shell(args,
+              'for f in /etc/kolla/neutron-*/neutron.conf; do '
+              'sudo crudini --set $f DEFAULT global_physnet_mtu %d; done'
+              % physnet_mtu)
+    run_shell(args,
+              'for f in /etc/kolla/neutron-*/ml2_conf.ini; do '
+              'sudo crudini --set $f ml2 path_mtu %d; done' % path_mtu)
+
+
 def kolla_gen_configs(args):
     '''Generate the configs using Jinja2
 
@@ -1802,8 +3040,12 @@ def kolla_gen_secrets(args):
               'python ./kolla-kubernetes/tools/secret-generator.py create')
 
 
-def kolla_create_config_maps(args):
-    '''Generate the Kolla config map'''
+def kolla_create_config_maps(args, replace=False):
+    '''Generate the Kolla config map
+
+    With replace the existing config maps are deleted first, to pick up
+    regenerated configs
+    '''
 
     print_progress(
         'Kolla',
@@ -1825,19 +3067,11 @@ def kolla_create_config_maps(args):
          'sensitive information.\n'
          'Users and system components alike can store configuration '
          'data in ConfigMap.')
-    run_shell(args,
-              'kollakube res create configmap '
-              'mariadb keystone horizon rabbitmq memcached nova-api '
-              'nova-conductor nova-scheduler glance-api-haproxy '
-              'glance-registry-haproxy glance-api glance-registry '
-              'neutron-server neutron-dhcp-agent neutron-l3-agent '
-              'neutron-metadata-agent neutron-openvswitch-agent '
-              'openvswitch-db-server openvswitch-vswitchd nova-libvirt '
-              'nova-compute nova-consoleauth nova-novncproxy '
-              'nova-novncproxy-haproxy neutron-server-haproxy '
-              'nova-api-haproxy cinder-api cinder-api-haproxy cinder-backup '
-              'cinder-scheduler cinder-volume iscsid tgtd keepalived '
-              'placement-api placement-api-haproxy')
+    if replace:
+        run_shell(args, 'kollakube res delete configmap %s' %
+                  ' '.join(KOLLA_CONFIG_MAPS))
+    run_shell(args, 'kollakube res create configmap %s' %
+              ' '.join(KOLLA_CONFIG_MAPS))
 
     demo(args, 'Lets look at a configmap',
          'kubectl get configmap -n kolla; kubectl describe '
@@ -1914,8 +3148,201 @@ def kolla_resolve_workaround(args):
         run_shell(args, './kolla-kubernetes/tools/setup-resolv-conf.sh kolla')
 
 
+def kolla_chart_graph(args, root='./kolla-kubernetes/helm'):
+    '''Read the metadata of every chart in the kolla-kubernetes repo
+
+    Returns a dictionary of chart directory to its name, version and the
+    directories of the charts it depends on, from Chart.yaml and
+    requirements.yaml
+    '''
+
+    # PyYAML comes with ansible, which is installed by now
+    import yaml
+
+    charts = {}
+    for path, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d not in ['charts', 'templates'])
+        if 'Chart.yaml' not in files:
+            continue
+        with open(os.path.join(path, 'Chart.yaml')) as f:
+            meta = yaml.safe_load(f)
+        requirements = {}
+        if 'requirements.yaml' in files:
+            with open(os.path.join(path, 'requirements.yaml')) as f:
+                requirements = yaml.safe_load(f) or {}
+        charts[os.path.normpath(path)] = {
+            'name': meta['name'],
+            'version': str(meta['version']),
+            'requires': requirements.get('dependencies') or []}
+
+    # Dependencies are local, by file:// path or by chart name
+    by_name = dict((info['name'], path) for path, info in charts.items())
+    for path, info in charts.items():
+        info['deps'] = []
+        for dep in info.pop('requires'):
+            repo = dep.get('repository', '')
+            if repo.startswith('file://'):
+                dep_path = os.path.normpath(os.path.join(path, repo[7:]))
+            else:
+                dep_path = by_name.get(dep['name'])
+            if dep_path in charts:
+                info['deps'].append(dep_path)
+    return(charts)
+
+
+def kolla_prebuild_charts(args):
+    '''Run the kolla-kubernetes prebuild scripts, see KOLLA_CHART_PREBUILDS
+
+    They change the chart sources, so they run before the charts are
+    hashed
+    '''
+
+    for script in KOLLA_CHART_PREBUILDS:
+        if not os.path.exists(script):
+            continue
+        rc, out, err = run_shell_status(args, script)
+        if rc != 0:
+            raise AbortScriptException('%s failed: %s' % (script, err))
+
+
+def kolla_chart_hashes(charts, root='./kolla-kubernetes/helm'):
+    '''Hash each chart's sources and the hashes of its dependencies
+
+    The charts/ subdirectory and requirements.lock are left out, they are
+    generated by the build. helm/all_values.yaml is hashed into every
+    chart, the prebuild writes the chart values from it.
+    '''
+
+    hashes = {}
+    all_values = b''
+    if os.path.exists(os.path.join(root, 'all_values.yaml')):
+        with open(os.path.join(root, 'all_values.yaml'), 'rb') as f:
+            all_values = f.read()
+
+    def chart_hash(path):
+        if path in hashes:
+            return(hashes[path])
+        digest = hashlib.sha256(all_values)
+        for top, dirs, files in os.walk(path):
+            if top == path:
+                dirs[:] = [d for d in dirs if d != 'charts']
+            dirs.sort()
+            for name in sorted(files):
+                if top == path and name == 'requirements.lock':
+                    continue
+                full = os.path.join(top, name)
+                digest.update(os.path.relpath(full, path).encode())
+                with open(full, 'rb') as f:
+                    digest.update(f.read())
+        for dep in sorted(charts[path]['deps']):
+            digest.update(chart_hash(dep).encode())
+        hashes[path] = digest.hexdigest()
+        return(hashes[path])
+
+    for path in charts:
+        chart_hash(path)
+    return(hashes)
+
+
+def kolla_cached_chart_digest(args, digest, package):
+    '''The sha256 of a chart package recorded in the chart cache, or None'''
+
+    path = os.path.join(ko_cache_dir(args, 'charts'), digest,
+                        package + '.sha256')
+    if not os.path.exists(path):
+        return(None)
+    with open(path) as f:
+        return(f.read().strip())
+
+
+def kolla_build_chart(args, path, info, digest, dest='/tmp'):
+    '''Build one chart, or restore it from the chart cache
+
+    The cache keeps the packaged chart, its sha256 and the charts/
+    subdirectory that helm dependency update made, so installs from the
+    chart directory work too. A package is only cached once it reads as
+    an archive, and only restored if it still matches its sha256.
+    Returns True if the chart was built.
+    '''
+
+    package = '%s-%s.tgz' % (info['name'], info['version'])
+    cached = os.path.join(ko_cache_dir(args, 'charts'), digest)
+    if os.path.exists(os.path.join(cached, package)):
+        if file_sha256(os.path.join(cached, package)) == \
+                kolla_cached_chart_digest(args, digest, package):
+            shutil.copyfile(os.path.join(cached, package),
+                            os.path.join(dest, package))
+            if os.path.exists(os.path.join(cached, 'charts.tar')):
+                run_shell(args, 'rm -rf %s/charts; tar -xf %s -C %s' %
+                          (path, os.path.join(cached, 'charts.tar'), path))
+            return(False)
+        print('  *Cached chart %s does not match its digest, building it '
+              'again*' % package)
+        run_shell(args, 'rm -rf %s' % cached)
+
+    if info['deps']:
+        run_shell(args, 'helm dependency update --skip-refresh %s' % path)
+    if '/compute-kits/' in path and os.path.exists(KOLLA_COMPUTE_KIT_BUILD):
+        # It builds every kit, one run at a time
+        with COMPUTE_KIT_LOCK:
+            rc, out, err = run_shell_status(
+                args, '%s %s' % (KOLLA_COMPUTE_KIT_BUILD, dest))
+    else:
+        rc, out, err = run_shell_status(
+            args, 'helm package %s --destination %s' % (path, dest))
+    built = os.path.join(dest, package)
+    if rc != 0 or not os.path.exists(built):
+        err = err or out
+        if not isinstance(err, str):
+            err = err.decode('utf-8', 'replace')
+        print('  *Building %s failed: %s*' % (package, err))
+        return(True)
+    if run_shell_status(args, 'tar -tzf %s > /dev/null' % built)[0] != 0:
+        print('  *helm package wrote a corrupt %s*' % package)
+        os.remove(built)
+        return(True)
+
+    run_shell(args, 'rm -rf %s.tmp; mkdir -p %s.tmp' % (cached, cached))
+    shutil.copyfile(built, os.path.join(cached + '.tmp', package))
+    with open(os.path.join(cached + '.tmp', package + '.sha256'), 'w') as w:
+        w.write(file_sha256(built))
+    if os.path.exists(os.path.join(path, 'charts')):
+        run_shell(args, 'tar -cf %s.tmp/charts.tar -C %s charts' %
+                  (cached, path))
+    run_shell(args, 'rm -rf %s; mv %s.tmp %s' % (cached, cached, cached))
+    return(True)
+
+
+def kolla_chart_layers(charts):
+    '''Group the charts in layers that only depend on earlier layers
+
+    Microservices and kolla-common come first, then the service charts
+    and then the metacharts
+    '''
+
+    depth = {}
+
+    def chart_depth(path):
+        if path not in depth:
+            depth[path] = 1 + max([chart_depth(dep) for dep in
+                                   charts[path]['deps']] or [-1])
+        return(depth[path])
+
+    layers = []
+    for path in sorted(charts):
+        d = chart_depth(path)
+        while len(layers) <= d:
+            layers.append([])
+        layers[d].append(path)
+    return(layers)
+
+
 def kolla_build_micro_charts(args):
-    '''Build all helm micro charts'''
+    '''Build all helm micro charts
+
+    Charts are cached by a hash of their sources and dependencies, so only
+    the charts that changed are built again
+    '''
 
     print_progress('Kolla',
                    'Build all Helm microcharts, service charts, '
@@ -1935,32 +3362,651 @@ def kolla_build_micro_charts(args):
          'This step builds all the known helm charts and '
          'dependencies (193)\n'
          'This is another step that takes a few minutes')
-    if args.demo:
-        print(run_shell(
-            args,
-            './kolla-kubernetes/tools/helm_build_all.sh /tmp'))
-    else:
-        run_shell(args, './kolla-kubernetes/tools/helm_build_all.sh /tmp')
+
+    kolla_prebuild_charts(args)
+    charts = kolla_chart_graph(args)
+    hashes = kolla_chart_hashes(charts)
+
+    # A layer at a time, a helm process per core. Threads, as forking
+    # while the prefetch and pull threads run is not safe.
+    built = 0
+    pool = ThreadPool(multiprocessing.cpu_count())
+    try:
+        for layer in kolla_chart_layers(charts):
+            built += sum(pool.map(
+                lambda path: kolla_build_chart(args, path, charts[path],
+                                               hashes[path]),
+                layer))
+    finally:
+        pool.close()
+        pool.join()
+    print('  Built %d charts on %d cores, %d unchanged from the chart cache' %
+          (built, multiprocessing.cpu_count(), len(charts) - built))
+    kolla_write_chart_manifest(args, charts, hashes)
+    run_shell(args, 'helm repo index /tmp')
 
     demo(args, 'Lets look at these helm charts',
          'helm list; helm search | grep local | wc -l; '
          'helm fetch url chart; helm inspect local/glance')
 
 
+def kolla_chart_key(path, root='./kolla-kubernetes/helm'):
+    '''The index key of a chart, like service/mariadb'''
+
+    return(os.path.relpath(path, os.path.normpath(root)))
+
+
+def kolla_write_chart_manifest(args, charts, hashes, dest='/tmp'):
+    '''Write the index of the built charts
+
+    Each chart's name, version, package, package digest, source hash and
+    dependencies, keyed by kolla_chart_key. The digest is the one the
+    chart cache recorded when the package was built, so a package that
+    was damaged after that does not verify.
+    '''
+
+    manifest = {}
+    for path, info in charts.items():
+        name = '%s-%s.tgz' % (info['name'], info['version'])
+        manifest[kolla_chart_key(path)] = {
+            'name': info['name'],
+            'version': info['version'],
+            'path': path,
+            'package': os.path.join(dest, name),
+            'sha256': kolla_cached_chart_digest(args, hashes[path], name),
+            'source_hash': hashes[path],
+            'deps': [kolla_chart_key(dep) for dep in info['deps']]}
+    save_json(CHART_MANIFEST, manifest)
+    CHART_INDEX.clear()
+    CHART_INDEX.update(manifest)
+
+
+def kolla_chart_index(args):
+    '''The chart index, loaded from the manifest once'''
+
+    if not CHART_INDEX:
+        CHART_INDEX.update(load_json(CHART_MANIFEST, {}))
+    return(CHART_INDEX)
+
+
+def kolla_chart_package(args, key):
+    '''Look up the package of a chart, like service/mariadb'''
+
+    index = kolla_chart_index(args)
+    if key not in index:
+        raise AbortScriptException('Chart %s is not in %s' %
+                                   (key, CHART_MANIFEST))
+    return(index[key]['package'])
+
+
+def kolla_bad_charts(args):
+    '''Charts in the index whose package is missing or corrupt'''
+
+    bad = []
+    for key, entry in sorted(kolla_chart_index(args).items()):
+        if entry['sha256'] is None or \
+                not os.path.exists(entry['package']) or \
+                file_sha256(entry['package']) != entry['sha256']:
+            bad.append(key)
+    return(bad)
+
+
 def kolla_verify_helm_images(args):
-    '''Check to see if enough helm charts were generated'''
+    '''Check every chart in the index was built and is intact
+
+    Charts that are missing or do not match their digest are removed from
+    the chart cache and built again, the rest are left alone. The index
+    must hold every service chart that is installed.
+    '''
 
     print_progress(
         'Kolla',
-        'Verify number of helm images',
+        'Verify helm charts',
         KOLLA_FINAL_PROGRESS)
 
-    out = run_shell(args, 'ls /tmp | grep ".tgz" | wc -l')
-    if int(out) > 190:
-        print('  %s Helm images created' % int(out))
-    else:
-        print('  Error: only %s Helm images created' % int(out))
+    index = kolla_chart_index(args)
+    missing = ['service/%s' % chart for chart, deps in KOLLA_SERVICE_DEPS
+               if 'service/%s' % chart not in index]
+    if not index or missing:
+        print('  Error: %d Helm charts indexed, missing %s. Is '
+              './kolla-kubernetes there?' %
+              (len(index), ', '.join(missing) or 'all'))
+        sys.exit(1)
+
+    bad = kolla_bad_charts(args)
+    if bad:
+        print('  Rebuilding %d charts: %s' % (len(bad), ', '.join(bad)))
+        charts = kolla_chart_graph(args)
+        hashes = kolla_chart_hashes(charts)
+        for key in bad:
+            path = kolla_chart_index(args)[key]['path']
+            run_shell(args, 'rm -rf %s' % os.path.join(
+                ko_cache_dir(args, 'charts'), hashes[path]))
+            kolla_build_chart(args, path, charts[path], hashes[path])
+        kolla_write_chart_manifest(args, charts, hashes)
+        run_shell(args, 'helm repo index /tmp')
+        bad = kolla_bad_charts(args)
+
+    if bad:
+        print('  Error: %d Helm charts are missing or corrupt: %s' %
+              (len(bad), ', '.join(bad)))
         sys.exit(1)
+    print('  %d Helm charts verified' % len(kolla_chart_index(args)))
+
+
+def kolla_cloud_values(args):
+    '''The global kolla values that cloud.yaml is rendered with
+
+    These also decide which docker images the charts will run
+    '''
+
+    image_tag = kolla_get_image_tag(args)
+    values = {'docker_namespace': args.docker_repo,
+              'image_tag': image_tag,
+              'base_distro': args.base_distro,
+              'install_type': 'source'}
+    if args.registry_mirror != 'None':
+        values['docker_registry'] = docker_registry_mirror(args)
+    if 'ocata' in args.image_version:
+        # No docker_namespace in a version 4 cloud.yaml
+        values['docker_namespace'] = 'kolla'
+    else:
+        for image in ['kolla_toolbox', 'haproxy', 'fluentd',
+                      'kubernetes_entrypoint']:
+            values['%s_image_tag' % image] = image_tag
+    return(values)
+
+
+def kolla_image_plan_key(args):
+    '''What the images a run renders depend on, besides the charts'''
+
+    return({'values': kolla_cloud_values(args),
+            'no_network': args.no_network,
+            'logs': args.logs})
+
+
+def kolla_plan_images(args):
+    '''List the docker images the OpenStack charts will run
+
+    In the order the charts are installed. The charts can only be rendered
+    once they are built, so this is the list kolla_pull_rendered_images
+    found by rendering them in the last run with the same values, or else
+    the KOLLA_CHART_IMAGES table.
+    '''
+
+    plan = load_json(os.path.join(ko_cache_dir(args, 'images'),
+                                  'plan.json'), {})
+    if plan.get('key') == kolla_image_plan_key(args):
+        return(plan['images'])
+
+    values = kolla_cloud_values(args)
+    images = []
+    for chart, names in KOLLA_CHART_IMAGES:
+        if args.no_network and chart in ['neutron', 'openvswitch']:
+            continue
+        if args.logs and chart == 'common':
+            names = names + ['fluentd']
+        for name in names:
+            tag = values.get('%s_image_tag' % name.replace('-', '_'),
+                             values['image_tag'])
+            image = '%s/%s-%s-%s:%s' % (
+                values['docker_namespace'], values['base_distro'],
+                values['install_type'], name, tag)
+            if 'docker_registry' in values:
+                image = '%s/%s' % (values['docker_registry'], image)
+            images.append(image)
+    return(images)
+
+
+def docker_pull_image(args, image):
+    '''Pull a docker image, return the image and the seconds it took
+
+    The seconds are None if the pull failed
+    '''
+
+    start = time.time()
+    run_shell(args, 'sudo docker pull %s' % image)
+    if not run_shell(args, 'sudo docker images -q %s' % image):
+        return((image, None))
+    return((image, time.time() - start))
+
+
+def docker_pull_images(args, images, concurrency):
+    '''Start pulling docker images in the background
+
+    At most concurrency images are pulled at the same time. Returns an
+    AsyncResult with a list of (image, seconds) pairs, see
+    docker_report_pulls.
+    '''
+
+    pool = ThreadPool(max(1, concurrency))
+    result = pool.map_async(lambda image: docker_pull_image(args, image),
+                            images)
+    pool.close()
+    return(result)
+
+
+def docker_report_pulls(pulls):
+    '''Print the time each docker pull took'''
+
+    failed = 0
+    for image, seconds in pulls:
+        if seconds is None:
+            failed += 1
+            print('  %-70s failed' % image)
+        else:
+            print('  %-70s %5.1fs' % (image, seconds))
+    if failed:
+        print('  *%d images failed to pull, kubelet will retry them*' %
+              failed)
+
+
+def docker_image_id(args, image):
+    '''Return the id of a local docker image, or an empty string'''
+
+    out = run_shell(args, 'sudo docker images -q %s' % image)
+    if not isinstance(out, str):
+        out = out.decode()
+    return(out)
+
+
+def docker_compressor(args):
+    '''pigz compresses on all cores, gzip is the fallback'''
+
+    if run_shell(args, 'which pigz'):
+        return('pigz')
+    return('gzip')
+
+
+def kolla_bundle_path(args):
+    '''The image bundle of this image version, repo and distro'''
+
+    name = '%s-%s-%s' % (args.docker_repo.replace('/', '_'),
+                         args.base_distro, args.image_version)
+    return(os.path.join(ko_cache_dir(args, 'bundles'), name + '.tar.gz'))
+
+
+def kolla_load_bundle(args):
+    '''Load the image bundle into docker
+
+    Returns the images the bundle holds
+    '''
+
+    bundle = kolla_bundle_path(args)
+    run_shell(args, '%s -dc %s | sudo docker load' %
+              (docker_compressor(args), bundle))
+    return(load_json(bundle + '.json', {}).get('images', {}).keys())
+
+
+def kolla_fetch_images(args, images):
+    '''Load the image bundle if asked to, then pull the missing images
+
+    Returns the images loaded from the bundle and the (image, seconds)
+    pairs of the pulls
+    '''
+
+    loaded = []
+    if args.bundle_load and os.path.exists(kolla_bundle_path(args)):
+        loaded = [image for image in kolla_load_bundle(args)
+                  if image in images and docker_image_id(args, image)]
+    missing = [image for image in images if image not in loaded]
+    pulls = docker_pull_images(args, missing, args.pull_concurrency)
+    return((loaded, pulls.get()))
+
+
+def kolla_prepull_images(args):
+    '''Start pulling all OpenStack images while Kolla is prepared
+
+    Otherwise kubelet pulls the images of each chart when it is installed,
+    behind the wait for the charts before it
+    '''
+
+    print_progress('Kolla', 'Pre-pull OpenStack docker images',
+                   KOLLA_FINAL_PROGRESS)
+    docker_gc_images(args)
+    images = kolla_plan_images(args)
+    demo(args, 'Pre-pull docker images',
+         'Pull %d images, %d at a time, in the background' %
+         (len(images), args.pull_concurrency))
+    pool = ThreadPool(1)
+    PREFETCHES['openstack-images'] = pool.apply_async(
+        kolla_fetch_images, (args, images))
+    pool.close()
+
+
+def kolla_rendered_images(args, graph):
+    '''List the images the service charts run, from helm template
+
+    The charts are rendered against /tmp/cloud.yaml, so edits made with
+    --edit_cloud are included. Returns None with a helm older than 2.8,
+    which has no helm template, or if a chart does not render.
+    '''
+
+    if not helm_has_template(args):
+        return(None)
+
+    run_shell(args, 'mkdir -p /tmp/rendered')
+    values_digest = file_sha256('/tmp/cloud.yaml')
+    order = [chart for chart, deps in KOLLA_SERVICE_DEPS if chart in graph]
+    order += sorted(set(graph) - set(order))
+    pool = ThreadPool(multiprocessing.cpu_count())
+    results = pool.map(
+        lambda chart: kolla_render_chart(args, chart, values_digest), order)
+    pool.close()
+
+    images = []
+    for chart, manifest, err in results:
+        if manifest is None:
+            logger.debug('Can not render %s: %s' % (chart, err))
+            return(None)
+        with open(manifest) as f:
+            for m in re.finditer(r'^[\s-]*image:\s*["\']?([^"\'\s]+)',
+                                 f.read(), re.M):
+                if m.group(1) not in images:
+                    images.append(m.group(1))
+    return(images)
+
+
+def kolla_pull_rendered_images(args, graph):
+    '''Pull the images of the rendered charts that the pre-pull missed
+
+    The rendered list is kept for the pre-pull of the next run
+    '''
+
+    images = kolla_rendered_images(args, graph)
+    if images is None:
+        return
+
+    planned = kolla_plan_images(args)
+    save_json(os.path.join(ko_cache_dir(args, 'images'), 'plan.json'),
+              {'key': kolla_image_plan_key(args), 'images': images})
+    missing = [image for image in images if image not in planned]
+    if missing:
+        print('  *Pulling %d images the pre-pull did not know about*' %
+              len(missing))
+        PREFETCHES['rendered-images'] = docker_pull_images(
+            args, missing, args.pull_concurrency)
+
+
+def kolla_report_image_pulls(args):
+    '''Report the pre-pulled OpenStack images'''
+
+    if 'openstack-images' not in PREFETCHES:
+        return
+    print_progress('Kolla', 'OpenStack docker image pull times',
+                   KOLLA_FINAL_PROGRESS)
+    loaded, pulls = PREFETCHES['openstack-images'].get()
+    if loaded:
+        print('  %d images loaded from %s' %
+              (len(loaded), kolla_bundle_path(args)))
+    if 'rendered-images' in PREFETCHES:
+        pulls = pulls + PREFETCHES['rendered-images'].get()
+    docker_report_pulls(pulls)
+
+
+def kolla_save_bundle(args):
+    '''Save the OpenStack images in a compressed bundle in the cache
+
+    One docker save of all the images, so layers they share are stored
+    once. The bundle is only written again when an image changed.
+    '''
+
+    print_progress('Kolla', 'Save OpenStack docker images bundle',
+                   KOLLA_FINAL_PROGRESS)
+    bundle = kolla_bundle_path(args)
+    images = {}
+    for image in kolla_plan_images(args):
+        image_id = docker_image_id(args, image)
+        if image_id:
+            images[image] = image_id
+
+    if not images:
+        print('  *No OpenStack images are present, no bundle saved*')
+        return
+    if load_json(bundle + '.json', {}).get('images') == images and \
+            os.path.exists(bundle):
+        print('  *Bundle %s is up to date*' % bundle)
+        return
+
+    # Only a complete save replaces the bundle and its manifest
+    rc, out, err = run_shell_status(
+        args, "bash -o pipefail -c 'sudo docker save %s | %s > %s.tmp'" %
+        (' '.join(sorted(images)), docker_compressor(args), bundle))
+    if rc != 0:
+        run_shell(args, 'rm -f %s.tmp' % bundle)
+        if not isinstance(err, str):
+            err = err.decode('utf-8', 'replace')
+        print('  *Saving bundle %s failed, kept the previous one: %s*' %
+              (bundle, err))
+        return
+    os.rename(bundle + '.tmp', bundle)
+    save_json(bundle + '.json', {'images': images})
+    print('  Saved %d images to %s' % (len(images), bundle))
+
+
+def docker_size(size):
+    '''Convert a docker size like 1.2GB to bytes'''
+
+    m = re.match(r'([0-9.]+)\s*([kKMGT]?)B', size)
+    if not m:
+        return(0)
+    return(int(float(m.group(1)) *
+               1000 ** ' kMGT'.index(m.group(2).replace('K', 'k') or ' ')))
+
+
+def docker_root_dir(args):
+    '''The directory docker keeps its images in'''
+
+    root = run_shell(args, "sudo docker info -f '{{.DockerRootDir}}' "
+                     "2>/dev/null")
+    if not isinstance(root, str):
+        root = root.decode()
+    if not root or not os.path.exists(root):
+        root = '/var/lib/docker'
+    return(root)
+
+
+def docker_disk_free(args):
+    '''Free bytes on the filesystem holding the docker images'''
+
+    st = os.statvfs(docker_root_dir(args))
+    return(st.f_bavail * st.f_frsize)
+
+
+def docker_images_disk_use(args):
+    '''Bytes the docker images take on disk
+
+    Layers shared by images are counted once, unlike the image sizes in
+    docker images, where kolla images all count their base layers again.
+    '''
+
+    out = run_shell(args, 'sudo docker system df')
+    if not isinstance(out, str):
+        out = out.decode()
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) >= 4 and fields[0] == 'Images':
+            return(docker_size(fields[3]))
+
+    # Docker without system df, measure the image store
+    out = run_shell(args, 'sudo du -sbx %s' % docker_root_dir(args))
+    if not isinstance(out, str):
+        out = out.decode()
+    try:
+        return(int(out.split()[0]))
+    except (IndexError, ValueError):
+        return(0)
+
+
+def docker_record_use(args, images):
+    '''Record that images are used now, for the image garbage collector'''
+
+    path = os.path.join(ko_cache_dir(args, 'images'), 'lru.json')
+    lru = load_json(path, {})
+    now = time.time()
+    for image in images:
+        lru[image] = now
+    save_json(path, lru)
+
+
+def docker_gc_images(args):
+    '''Remove docker images outside the retention policy
+
+    The images of this deployment and its control plane are always kept.
+    Kolla images are kept for the --keep_tags most recently used tags,
+    counting this deployment's tag, and removed for other tags. Then the
+    least recently used of the remaining images are removed until the
+    images fit in --image_budget GB. Images kept for this deployment are
+    reused by it instead of pulled again.
+    '''
+
+    wanted = kolla_plan_images(args) + k8s_control_plane_images(args)
+    tag = kolla_cloud_values(args)['image_tag']
+    docker_record_use(args, wanted)
+    lru = load_json(os.path.join(ko_cache_dir(args, 'images'), 'lru.json'),
+                    {})
+
+    out = run_shell(args, "sudo docker images --format "
+                    "'{{.Repository}}:{{.Tag}}'")
+    if not isinstance(out, str):
+        out = out.decode()
+    images = [image for image in out.split()
+              if '<none>' not in image]
+
+    # Kolla images are named <namespace>/<distro>-<type>-<name>:<tag>
+    kolla = re.compile(r'.*/[a-z]+-(source|binary)-[^:]+:(.+)$')
+    tag_used = {tag: time.time()}
+    for image in images:
+        m = kolla.match(image)
+        if m:
+            tag_used[m.group(2)] = max(tag_used.get(m.group(2), 0),
+                                       lru.get(image, 0))
+    keep_tags = sorted(tag_used, key=tag_used.get,
+                       reverse=True)[:max(1, args.keep_tags)]
+
+    remove = []
+    keep = []
+    for image in images:
+        m = kolla.match(image)
+        if image in wanted or 'registry:2' in image:
+            keep.append(image)
+        elif m and m.group(2) not in keep_tags:
+            remove.append(image)
+        else:
+            keep.append(image)
+
+    free = docker_disk_free(args)
+    for image in remove:
+        run_shell(args, 'sudo docker rmi %s' % image)
+    run_shell(args, "sudo docker rmi $(sudo docker images "
+              "-q -f 'dangling=true')")
+
+    # Over budget, remove the least recently used images. Removing an
+    # image only frees the layers no other image uses, so measure again
+    # after each one.
+    budget = args.image_budget * 1000 ** 3
+    for image in sorted(keep, key=lambda image: lru.get(image, 0)):
+        if image in wanted or 'registry:2' in image:
+            continue
+        if docker_images_disk_use(args) <= budget:
+            break
+        run_shell(args, 'sudo docker rmi %s' % image)
+        keep.remove(image)
+        remove.append(image)
+    freed = docker_disk_free(args) - free
+
+    reused = [image for image in keep if image in wanted]
+    print('  Kept %d images (tags %s), removed %d, freed %.1f GB' %
+          (len(keep), ', '.join(keep_tags), len(remove),
+           max(0, freed) / 1000.0 ** 3))
+    print('  %d of %d images for this deployment are already local' %
+          (len(reused), len(wanted)))
+
+
+def kolla_cloud_model(args):
+    '''The cloud.yaml settings, from kolla_cloud_values and the user's
+    inputs
+
+    Version 4 (Ocata) and 5+ (Pike) images need a different layout
+    '''
+
+    values = kolla_cloud_values(args)
+    lvm_backends = [{args.mgmt_ip: 'cinder-volumes'}]
+    if args.cinder_wip and 'ocata' not in args.image_version:
+        # Replaced by the backends cinder_wip adds
+        lvm_backends = None
+
+    kolla_all = {
+        'image_tag': values['image_tag'],
+        'kube_logger': False,
+        'external_vip': args.mgmt_ip,
+        'base_distro': values['base_distro'],
+        'install_type': values['install_type'],
+        'tunnel_interface': args.MGMT_INT,
+        'kolla_kubernetes_external_subnet': 24,
+        'kolla_kubernetes_external_vip': args.vip_ip,
+    }
+    for key in ['docker_registry', 'kolla_toolbox_image_tag',
+                'haproxy_image_tag', 'fluentd_image_tag',
+                'kubernetes_entrypoint_image_tag']:
+        if key in values:
+            kolla_all[key] = values[key]
+
+    kolla = {
+        'all': kolla_all,
+        'keepalived': {'all': {'api_interface': 'br-ex'}},
+        'keystone': {'all': {'admin_port_external': 'true',
+                             'dns_name': args.mgmt_ip,
+                             'port': 5000},
+                     'public': {'all': {'port_external': 'true'}}},
+        'rabbitmq': {'all': {'cookie': 67}},
+        'glance': {'api': {'all': {'port_external': 'true'}}},
+        'cinder': {'api': {'all': {'port_external': 'true'}},
+                   'volume_lvm': {
+                       'all': {'element_name': 'cinder-volume'},
+                       'daemonset': {'lvm_backends': lvm_backends}}},
+        'ironic': {'conductor': {
+            'daemonset': {'selector_key': 'kolla_conductor'}}},
+        'openvwswitch': {'all': {'add_port': True,
+                                 'ext_bridge_name': 'br-ex',
+                                 'ext_interface_name': args.NEUTRON_INT,
+                                 'setup_bridge': True}},
+        'horizon': {'all': {'port_external': True}},
+    }
+    novncproxy = {'all': {'port': 6080, 'port_external': True}}
+
+    if 'ocata' in args.image_version:
+        kolla['nova'] = {
+            'placement_api': {'all': {'port_external': True}},
+            'novncproxy': novncproxy}
+    else:
+        kolla_all.update({'docker_namespace': values['docker_namespace'],
+                          'ceph_backend': False,
+                          'libvirt_tcp': False})
+        kolla['nova'] = {
+            'all': {'placement_api_enabled': True, 'cell_enabled': True},
+            'novncproxy': novncproxy,
+            'api': {'create_cell': {'job': {'cell_wait_compute': False}}}}
+
+    return({'global': {'kolla': kolla}})
+
+
+def kolla_write_cloud(args, cloud='/tmp/cloud.yaml'):
+    '''Render cloud.yaml from kolla_cloud_model in one write'''
+
+    # PyYAML comes with ansible, which is installed by now
+    import yaml
+
+    with open(cloud + '.tmp', 'w') as w:
+        yaml.safe_dump(kolla_cloud_model(args), w,
+                       default_flow_style=False)
+    os.rename(cloud + '.tmp', cloud)
+
+    if args.edit_cloud:
+        pause_tool_execution('Pausing to edit the /tmp/cloud.yaml file')
+
+    if args.demo:
+        print(run_shell(args, 'sudo cat /tmp/cloud.yaml'))
 
 
 def kolla_create_cloud_v4(args):
@@ -1983,83 +4029,7 @@ def kolla_create_cloud_v4(args):
          'and key-value pairs, which\n'
          'guide helm when running each chart. This includes '
          'our basic inputs, MGMT and Neutron')
-    cloud = '/tmp/cloud.yaml'
-    with open(cloud, "w") as w:
-        w.write("""
-global:
-   kolla:
-     all:
-       image_tag: "%s"
-       kube_logger: false
-       external_vip: "%s"
-       base_distro: "%s"
-       install_type: "source"
-       tunnel_interface: "%s"
-       kolla_kubernetes_external_subnet: 24
-       kolla_kubernetes_external_vip: %s
-     keepalived:
-       all:
-         api_interface: br-ex
-     keystone:
-       all:
-         admin_port_external: "true"
-         dns_name: "%s"
-         port: 5000
-       public:
-         all:
-           port_external: "true"
-     rabbitmq:
-       all:
-         cookie: 67
-     glance:
-       api:
-         all:
-           port_external: "true"
-     cinder:
-       api:
-         all:
-           port_external: "true"
-       volume_lvm:
-         all:
-           element_name: cinder-volume
-         daemonset:
-           lvm_backends:
-           - '%s': 'cinder-volumes'
-     ironic:
-       conductor:
-         daemonset:
-           selector_key: "kolla_conductor"
-     nova:
-       placement_api:
-         all:
-           port_external: true
-       novncproxy:
-         all:
-           port: 6080
-           port_external: true
-     openvwswitch:
-       all:
-         add_port: true
-         ext_bridge_name: br-ex
-         ext_interface_name: %s
-         setup_bridge: true
-     horizon:
-       all:
-         port_external: true
-        """ % (kolla_get_image_tag(args),
-               args.mgmt_ip,
-               args.base_distro,
-               args.MGMT_INT,
-               args.vip_ip,
-               args.mgmt_ip,
-               args.mgmt_ip,
-               args.NEUTRON_INT))
-
-    if args.edit_cloud:
-        pause_tool_execution('Pausing to edit the /tmp/cloud.yaml file')
-
-    if args.demo:
-        print(run_shell(args, 'sudo cat /tmp/cloud.yaml'))
+    kolla_write_cloud(args)
 
 
 def kolla_create_cloud(args):
@@ -2072,135 +4042,460 @@ def kolla_create_cloud(args):
     This works for tag versions 5+
     '''
 
-    # Note for local registry add "docker_registry: 127.0.0.1:30401"
-
     print_progress(
         'Kolla',
         'Create a version 5+ cloud.yaml',
         KOLLA_FINAL_PROGRESS)
 
-    image_tag = kolla_get_image_tag(args)
-
     demo(args, 'Create a 5.x (Pike) cloud.yaml',
          'cloud.yaml is the partner to globals.yml\n'
          'It contains a list of global OpenStack services '
          'and key-value pairs, which\n'
          'guide helm when running each chart. This includes our '
          'basic inputs, MGMT and Neutron')
-    cloud = '/tmp/cloud.yaml'
-    with open(cloud, "w") as w:
-        w.write("""
-global:
-   kolla:
-     all:
-       docker_namespace: %s
-       image_tag: "%s"
-       kube_logger: false
-       external_vip: "%s"
-       base_distro: "%s"
-       install_type: source
-       tunnel_interface: "%s"
-       ceph_backend: false
-       libvirt_tcp: false
-       kolla_kubernetes_external_subnet: 24
-       kolla_kubernetes_external_vip: %s
-       kolla_toolbox_image_tag: %s
-       haproxy_image_tag: %s
-       fluentd_image_tag: %s
-       kubernetes_entrypoint_image_tag: %s
-     keepalived:
-       all:
-         api_interface: br-ex
-     keystone:
-       all:
-         admin_port_external: "true"
-         dns_name: "%s"
-         port: 5000
-       public:
-         all:
-           port_external: "true"
-     rabbitmq:
-       all:
-         cookie: 67
-     glance:
-       api:
-         all:
-           port_external: "true"
-     cinder:
-       api:
-         all:
-           port_external: "true"
-       volume_lvm:
-         all:
-           element_name: cinder-volume
-         daemonset:
-           lvm_backends:
-           - '%s': 'cinder-volumes'
-     nova:
-       all:
-         placement_api_enabled: true
-         cell_enabled: true
-       novncproxy:
-         all:
-           port: 6080
-           port_external: true
-       api:
-         create_cell:
-           job:
-             cell_wait_compute: false
-     ironic:
-       conductor:
-         daemonset:
-           selector_key: "kolla_conductor"
-     openvwswitch:
-       all:
-         add_port: true
-         ext_bridge_name: br-ex
-         ext_interface_name: %s
-         setup_bridge: true
-     horizon:
-       all:
-         port_external: true
-        """ % (args.docker_repo,
-               image_tag,
-               args.mgmt_ip,
-               args.base_distro,
-               args.MGMT_INT,
-               args.vip_ip,
-               image_tag,
-               image_tag,
-               image_tag,
-               image_tag,
-               args.mgmt_ip,
-               args.mgmt_ip,
-               args.NEUTRON_INT))
-
-    if args.cinder_wip:
-        # Cloud.yaml remove backend because replacing with own
-        rem = 'cinder-volumes'
-        run_shell(args,
-                  "sudo sed -i '/%s/d' %s" % (rem, cloud))
+    kolla_write_cloud(args)
 
-    if args.edit_cloud:
-        pause_tool_execution('Pausing to edit the /tmp/cloud.yaml file')
 
-    if args.demo:
-        print(run_shell(args, 'sudo cat /tmp/cloud.yaml'))
+def helm_install_release(args, key, name, timeout=900):
+    '''helm install a chart and wait for its resources to be ready
 
+    Returns the release name, whether it succeeded, the seconds it took
+    and the last lines of output
+    '''
 
-def helm_install_service_chart(args, chart_list):
-    '''helm install a list of service charts'''
+    start = time.time()
+    rc, out, err = run_shell_status(
+        args,
+        'helm install --debug %s --namespace kolla --name %s '
+        '--values /tmp/cloud.yaml --wait --timeout %d' %
+        (kolla_chart_package(args, key), name, timeout))
+    out = err or out
+    if not isinstance(out, str):
+        out = out.decode('utf-8', 'replace')
+    return((name, rc == 0, time.time() - start,
+            '\n'.join(out.splitlines()[-3:])))
+
+
+def kolla_values_services(values):
+    '''The kubernetes services listed under dependencies: service: in
+    chart values, at any depth, for kubernetes-entrypoint
+    '''
+
+    services = set()
+    if isinstance(values, dict):
+        for key, value in values.items():
+            if key == 'dependencies' and isinstance(value, dict):
+                names = value.get('service') or []
+                if not isinstance(names, list):
+                    names = str(names).replace(',', ' ').split()
+                services.update(str(name) for name in names)
+            services |= kolla_values_services(value)
+    elif isinstance(values, list):
+        for value in values:
+            services |= kolla_values_services(value)
+    return(services)
+
+
+def kolla_graph_has_cycle(graph):
+    '''Whether a chart depends on itself through its dependencies'''
+
+    state = {}
+
+    def visit(chart):
+        if state.get(chart) == 'done':
+            return(False)
+        if state.get(chart) == 'visiting':
+            return(True)
+        state[chart] = 'visiting'
+        if any(visit(dep) for dep in graph[chart]):
+            return(True)
+        state[chart] = 'done'
+        return(False)
+
+    return(any(visit(chart) for chart in graph))
+
+
+def kolla_service_graph(args):
+    '''The dependency graph of the OpenStack service charts
+
+    Each service chart requires a <service>-svc microservice for every
+    kubernetes service it provides, and its values list the services its
+    pods wait for. A chart depends on the charts providing those. The
+    KOLLA_SERVICE_DEPS edges are used for a chart whose values can not be
+    read, and for all of them if the result has a cycle.
+
+    Returns a dictionary of chart to the set of charts it depends on
+    '''
+
+    # PyYAML comes with ansible, which is installed by now
+    import yaml
+
+    table = dict((chart, set(deps)) for chart, deps in KOLLA_SERVICE_DEPS)
+    index = kolla_chart_index(args)
+    provides = {}
+    for chart in table:
+        for dep in index.get('service/%s' % chart, {}).get('deps', []):
+            name = os.path.basename(dep)
+            if name.endswith('-svc'):
+                provides[name[:-len('-svc')]] = chart
+
+    graph = {}
+    for chart in table:
+        values = os.path.join(
+            index.get('service/%s' % chart, {}).get('path', ''),
+            'values.yaml')
+        if not provides or not os.path.exists(values):
+            logger.debug('No values for %s, using KOLLA_SERVICE_DEPS' %
+                         chart)
+            graph[chart] = table[chart]
+            continue
+        with open(values) as f:
+            services = kolla_values_services(yaml.safe_load(f))
+        graph[chart] = set(provides[service] for service in services
+                           if provides.get(service, chart) != chart)
+
+    if kolla_graph_has_cycle(graph):
+        print('  *The chart values make a dependency cycle, using '
+              'KOLLA_SERVICE_DEPS*')
+        return(table)
+    return(graph)
+
+
+def kolla_service_layers(graph):
+    '''Group the charts of a service graph in dependency layers
+
+    A chart's layer is the length of the longest chain of charts it
+    depends on, so each layer only depends on earlier layers
+    '''
+
+    depth = {}
+
+    def chart_depth(chart):
+        if chart not in depth:
+            depth[chart] = 1 + max([chart_depth(dep) for dep in graph[chart]]
+                                   or [-1])
+        return(depth[chart])
+
+    layers = []
+    for chart in sorted(graph):
+        d = chart_depth(chart)
+        while len(layers) <= d:
+            layers.append([])
+        layers[d].append(chart)
+    return(layers)
+
+
+def helm_install_graph(args, graph, hooks=None):
+    '''helm install charts as soon as the charts they depend on are ready
+
+    Up to --parallel_install charts are installed at a time, by default
+    as many as the widest dependency layer. After a chart is ready its
+    hook, a function of args, is run. If a chart or its hook fails the
+    charts that depend on it are skipped while the others carry on; all
+    results are reported and the run is aborted at the end if any failed.
+    '''
+
+    order = [chart for chart, deps in KOLLA_SERVICE_DEPS if chart in graph]
+    order += sorted(set(graph) - set(order))
+    done = set()
+    failed = set()
+    running = set()
+    hooks = hooks or {}
+    results = queue.Queue()
+    concurrency = args.parallel_install
+    if concurrency < 1:
+        concurrency = max(len(layer) for layer in kolla_service_layers(graph))
+    pool = ThreadPool(concurrency)
+
+    def install(chart):
+        try:
+            return(helm_install_release(args, 'service/%s' % chart, chart))
+        except Exception as e:
+            return((chart, False, 0, str(e)))
+
+    def start_ready():
+        for chart in order:
+            if len(running) >= concurrency:
+                return
+            if chart in done or chart in failed or chart in running:
+                continue
+            if graph[chart] & failed:
+                print('  %-20s skipped, needs %s' %
+                      (chart, ', '.join(sorted(graph[chart] & failed))))
+                failed.add(chart)
+                continue
+            if graph[chart] <= done:
+                running.add(chart)
+                print_progress(
+                    'Kolla', "Helm Install service chart: \--'%s'--/" %
+                    chart, KOLLA_FINAL_PROGRESS)
+                pool.apply_async(install, (chart,), callback=results.put)
+
+    start_ready()
+    while running:
+        # Wake up now and then so Ctrl-C is not ignored
+        try:
+            name, ok, seconds, out = results.get(timeout=5)
+        except queue.Empty:
+            continue
+        running.discard(name)
+        if ok and name in hooks:
+            try:
+                hooks[name](args)
+            except AbortScriptException as e:
+                ok, out = False, str(e)
+        if ok:
+            done.add(name)
+            print('  %-20s ready in %5.1fs' % (name, seconds))
+        else:
+            failed.add(name)
+            print('  %-20s FAILED after %5.1fs:\n%s' %
+                  (name, seconds, out))
+        start_ready()
+    pool.close()
+
+    if failed:
+        raise AbortScriptException('Helm releases failed or skipped: %s' %
+                                   ', '.join(sorted(failed)))
+
+
+def kolla_bring_up_br_ex(args, timeout=600):
+    '''Bring up br-ex for keepalived to bind the VIP to it
+
+    openvswitch runs as DaemonSets, which helm --wait does not wait for,
+    so wait for its pods to run and for br-ex to exist first
+    '''
+
+    k8s_wait_for_chart_running(args, 'openvswitch', timeout)
+    start = time.time()
+    while not os.path.exists('/sys/class/net/br-ex'):
+        if time.time() - start > timeout:
+            raise AbortScriptException('openvswitch did not create br-ex '
+                                       'after %ds' % timeout)
+        time.sleep(2)
+    rc, out, err = run_shell_status(args, 'sudo ifconfig br-ex up')
+    if rc != 0:
+        if not isinstance(err, str):
+            err = err.decode('utf-8', 'replace')
+        raise AbortScriptException('Can not bring up br-ex: %s' % err)
+
+
+def kolla_render_chart(args, chart, values_digest):
+    '''Render a service chart against /tmp/cloud.yaml with helm template
+
+    Rendered manifests are cached by the chart package digest and the
+    values, so a chart is only rendered again when either changed.
+    Returns the chart, the manifest path or None and the error output.
+    '''
+
+    entry = kolla_chart_index(args)['service/%s' % chart]
+    digest = hashlib.sha256(('%s %s %s' % (chart, entry['sha256'],
+                                           values_digest)).encode())
+    cached = os.path.join(ko_cache_dir(args, 'rendered'),
+                          digest.hexdigest() + '.yaml')
+    manifest = '/tmp/rendered/%s.yaml' % chart
+    if not os.path.exists(cached):
+        rc, out, err = run_shell_status(
+            args,
+            'helm template %s --name %s --namespace kolla '
+            '--values /tmp/cloud.yaml > %s.tmp && mv %s.tmp %s' %
+            (entry['package'], chart, cached, cached, cached))
+        if rc != 0:
+            return((chart, None, err))
+    shutil.copyfile(cached, manifest)
+    return((chart, manifest, ''))
+
+
+def helm_has_template(args):
+    '''helm template renders charts client-side, from helm 2.8'''
+
+    return(tuple(int(v) for v in args.helm_version.split('.')[:2]) >= (2, 8))
+
+
+def helm_check_bulk_apply(args):
+    '''--bulk_apply needs helm template, from helm 2.8
+
+    It makes no helm releases, so there is nothing to --reconfigure
+    '''
+
+    if not args.bulk_apply:
+        return
+    if args.reconfigure:
+        raise AbortScriptException('--reconfigure upgrades helm releases, '
+                                   'which --bulk_apply does not make')
+    if not helm_has_template(args):
+        raise AbortScriptException('--bulk_apply needs helm template, from '
+                                   'helm 2.8, not helm %s' %
+                                   args.helm_version)
+
+
+def helm_bulk_apply(args, graph, hooks=None):
+    '''Render all service charts client-side and apply them in bulk
+
+    The charts are rendered once, in parallel, then applied with one
+    kubectl apply per dependency layer, without a Tiller round trip per
+    release. The pods wait for their dependencies themselves. The hooks,
+    functions of args, run once all pods are running.
+
+    The resources belong to no helm release, so helm list does not show
+    them and --reconfigure can not upgrade them.
+    '''
+
+    print_progress('Kolla', 'Render %d service charts' % len(graph),
+                   KOLLA_FINAL_PROGRESS)
+    run_shell(args, 'mkdir -p /tmp/rendered')
+    values_digest = file_sha256('/tmp/cloud.yaml')
+    pool = ThreadPool(multiprocessing.cpu_count())
+    results = pool.map(
+        lambda chart: kolla_render_chart(args, chart, values_digest),
+        sorted(graph))
+    pool.close()
+    failed = [(chart, err) for chart, manifest, err in results
+              if manifest is None]
+    for chart, err in failed:
+        print('  %-20s FAILED to render:\n%s' % (chart, err))
+    if failed:
+        raise AbortScriptException('Could not render %s' %
+                                   ', '.join(chart for chart, e in failed))
+
+    for charts in kolla_service_layers(graph):
+        print_progress('Kolla', 'Apply %s' % ', '.join(charts),
+                       KOLLA_FINAL_PROGRESS)
+        rc, out, err = run_shell_status(
+            args, 'kubectl apply -n kolla %s' %
+            ' '.join('-f /tmp/rendered/%s.yaml' % c for c in charts))
+        if rc != 0:
+            if not isinstance(err, str):
+                err = err.decode('utf-8', 'replace')
+            raise AbortScriptException('kubectl apply of %s failed: %s' %
+                                       (', '.join(charts), err))
 
-    for chart in chart_list:
-        print_progress(
-            'Kolla', "Helm Install service chart: \--'%s'--/" %
-            chart, KOLLA_FINAL_PROGRESS)
-        run_shell(args,
-                  'helm install --debug kolla-kubernetes/helm/service/%s '
-                  '--namespace kolla --name %s --values /tmp/cloud.yaml'
-                  % (chart, chart))
-        k8s_wait_for_pod_start(args, chart)
     k8s_wait_for_running_negate(args)
+    for chart in sorted(hooks or {}):
+        hooks[chart](args)
+
+
+def helm_release_changed(args, chart):
+    '''Whether a release renders differently with /tmp/cloud.yaml
+
+    Compares the manifest of a dry-run upgrade with the deployed one
+    '''
+
+    current = run_shell(args, 'helm get manifest %s' % chart)
+    rc, out, err = run_shell_status(
+        args,
+        'helm upgrade --dry-run --debug %s %s --values /tmp/cloud.yaml' %
+        (chart, kolla_chart_package(args, 'service/%s' % chart)))
+    if rc != 0:
+        raise AbortScriptException('Could not render %s: %s' % (chart, err))
+    if not isinstance(out, str):
+        out = out.decode()
+        current = current.decode()
+    rendered = out.split('MANIFEST:', 1)[-1]
+
+    def lines(text):
+        return([line.rstrip() for line in text.splitlines()
+                if line.strip()])
+
+    return(lines(rendered) != lines(current))
+
+
+def k8s_config_map_digests(args, namespace='kolla'):
+    '''Return a dictionary of config map name to a digest of its data'''
+
+    out = run_shell(args, 'kubectl get configmap -n %s -o json' % namespace)
+    if not isinstance(out, str):
+        out = out.decode()
+    try:
+        items = json.loads(out).get('items', [])
+    except ValueError:
+        return({})
+    return(dict((item['metadata']['name'],
+                 hashlib.sha256(json.dumps(item.get('data', {}),
+                                           sort_keys=True).encode()
+                                ).hexdigest())
+                for item in items))
+
+
+def helm_release_config_maps(args, chart):
+    '''The config maps the pods of a release mount'''
+
+    out = run_shell(args, 'helm get manifest %s' % chart)
+    if not isinstance(out, str):
+        out = out.decode()
+    return(set(re.findall(r'configMap:\s+name:\s*["\']?([\w.-]+)', out)))
+
+
+def kolla_reconfigure(args):
+    '''Apply changed options to a running deployment
+
+    globals.yml, the configs and config maps generated from it, and
+    cloud.yaml are rendered again from the options. Only the releases
+    whose rendered manifests or config maps changed are upgraded, in
+    dependency order, the rest are left untouched. Pods only read their
+    config maps when they start, so releases with changed config maps are
+    upgraded with --recreate-pods.
+    '''
+
+    global KOLLA_FINAL_PROGRESS
+
+    banner('Kolla - reconfigure OpenStack:')
+    clean_progress()
+    add_one_to_progress()
+    KOLLA_FINAL_PROGRESS = 9
+
+    if not kolla_chart_index(args):
+        raise AbortScriptException('No chart index in %s, deploy first' %
+                                   CHART_MANIFEST)
+    deployed = run_shell(args, 'helm list -q')
+    if not isinstance(deployed, str):
+        deployed = deployed.decode()
+    deployed = deployed.split()
+    if not deployed:
+        raise AbortScriptException('No helm releases to reconfigure, a '
+                                   '--bulk_apply deployment has none')
+
+    config_maps = k8s_config_map_digests(args)
+    kolla_modify_globals(args)
+    kolla_gen_configs(args)
+    kolla_enable_qemu(args)
+    kolla_set_neutron_mtu(args)
+    kolla_gen_secrets(args)
+    kolla_create_config_maps(args, replace=True)
+    new_config_maps = k8s_config_map_digests(args)
+    changed_maps = set(name for name in KOLLA_CONFIG_MAPS
+                       if config_maps.get(name) != new_config_maps.get(name))
+    if 'ocata' in args.image_version:
+        kolla_create_cloud_v4(args)
+    else:
+        kolla_create_cloud(args)
+
+    print_progress('Kolla', 'Compare rendered releases and config maps',
+                   KOLLA_FINAL_PROGRESS)
+    restart = [chart for chart, deps in KOLLA_SERVICE_DEPS
+               if chart in deployed and
+               helm_release_config_maps(args, chart) & changed_maps]
+    changed = [chart for chart, deps in KOLLA_SERVICE_DEPS
+               if chart in deployed and
+               (chart in restart or helm_release_changed(args, chart))]
+    print('  %d config maps changed: %s' %
+          (len(changed_maps), ', '.join(sorted(changed_maps)) or 'none'))
+    print('  %d of %d releases changed: %s' %
+          (len(changed), len(deployed), ', '.join(changed) or 'none'))
+
+    print_progress('Kolla', 'Upgrade changed releases',
+                   KOLLA_FINAL_PROGRESS)
+    for chart in changed:
+        rc, out, err = run_shell_status(
+            args,
+            'helm upgrade --wait --timeout 900 %s%s %s '
+            '--values /tmp/cloud.yaml' %
+            ('--recreate-pods ' if chart in restart else '', chart,
+             kolla_chart_package(args, 'service/%s' % chart)))
+        if rc != 0:
+            raise AbortScriptException('helm upgrade of %s failed: %s' %
+                                       (chart, err))
+        print('  *%s upgraded*' % chart)
 
 
 def helm_install_micro_service_chart(args, chart_list):
@@ -2211,9 +4506,10 @@ def helm_install_micro_service_chart(args, chart_list):
             'Kolla', "Helm Install micro service chart: \--'%s'--/" %
             chart, KOLLA_FINAL_PROGRESS)
         run_shell(args,
-                  'helm install --debug kolla-kubernetes/helm/microservice/%s '
+                  'helm install --debug %s '
                   '--namespace kolla --name %s --values /tmp/cloud.yaml'
-                  % (chart, chart))
+                  % (kolla_chart_package(args, 'microservice/%s' % chart),
+                     chart))
     k8s_wait_for_running_negate(args)
 
 
@@ -2227,6 +4523,7 @@ def kolla_create_keystone_user(args):
     print_progress('Kolla',
                    'Create a keystone admin account and source in to it',
                    KOLLA_FINAL_PROGRESS)
+    kolla_wait_for_apis(args, ['keystone'])
 
     run_shell(args, 'sudo rm -f ~/keystonerc_admin')
     run_shell(args,
@@ -2239,6 +4536,7 @@ def kolla_allow_ingress(args):
         'Kolla',
         'Allow Ingress by changing neutron rules',
         KOLLA_FINAL_PROGRESS)
+    kolla_wait_for_apis(args, ['keystone', 'neutron'])
     new = '/tmp/neutron_rules.sh'
     with open(new, "w") as w:
         w.write("""
@@ -2283,7 +4581,19 @@ def kolla_pike_workaround(args):
         k8s_wait_for_running_negate(args)
 
 
-def kolla_get_host_subnet(args):
+def kolla_allocate_on_subnet(args, iface, subnet, purpose, count):
+    '''Allocate addresses for purpose and return them the way callers want
+
+    Return the subnet, first ip address and its last octet
+    '''
+
+    ips = net_allocate_ips(args, iface, subnet, purpose, count)
+    if not ips:
+        return(subnet, None, None)
+    return(subnet, ips[0], int(ips[0].split('.')[3]))
+
+
+def kolla_get_host_subnet(args, purpose='demo', count=1):
     '''Grab an address to access a demo vm
 
     Return the subnet, actual ip address and the last octet to start the DHCP
@@ -2296,17 +4606,11 @@ def kolla_get_host_subnet(args):
         "ip route | grep default | grep %s | awk '{ print $3 }'" %
         args.MGMT_INT)
     subnet = default[:default.rfind(".")]
-    r = list(range(2, 253))
-    random.shuffle(r)
-    for k in r:
-        vip = run_shell(args, 'sudo nmap -sP -PR %s.%s' % (subnet, k))
-        if "Host seems down" in vip:
-            ip = subnet + '.' + str(k)
-            break
-    return(subnet, ip, k)
+    return(kolla_allocate_on_subnet(args, args.MGMT_INT, subnet, purpose,
+                                    count))
 
 
-def kolla_get_mgmt_subnet(args):
+def kolla_get_mgmt_subnet(args, purpose='demo', count=1):
     '''Grab an address to access a demo vm
 
     Return the subnet, actual ip address and the last octet to start the DHCP
@@ -2314,51 +4618,192 @@ def kolla_get_mgmt_subnet(args):
     '''
 
     subnet = args.mgmt_ip[:args.mgmt_ip.rfind(".")]
-    r = list(range(2, 253))
-    random.shuffle(r)
-    for k in r:
-        vip = run_shell(args, 'sudo nmap -sP -PR %s.%s' % (subnet, k))
-        if "Host seems down" in vip:
-            ip = subnet + '.' + str(k)
-            break
-    return(subnet, ip, k)
+    return(kolla_allocate_on_subnet(args, args.MGMT_INT, subnet, purpose,
+                                    count))
 
 
-def kolla_get_neutron_subnet(args):
-    '''Find and return a neutron ip address
+def net_lease_address(iface):
+    '''Return the address of the newest DHCP lease for iface, or None
+
+    Looks through the dhclient, NetworkManager and systemd-networkd lease
+    files, newest file last.
+    '''
+
+    lease_files = []
+    for pattern in ['/var/lib/dhcp/*.leases', '/var/lib/dhclient/*.lease*',
+                    '/var/lib/NetworkManager/*.lease',
+                    '/run/systemd/netif/leases/*']:
+        lease_files.extend(glob.glob(pattern))
+    lease_files.sort(key=os.path.getmtime)
+
+    try:
+        with open('/sys/class/net/%s/ifindex' % iface) as f:
+            ifindex = f.read().strip()
+    except IOError:
+        ifindex = None
+
+    address = None
+    for lease_file in lease_files:
+        try:
+            with open(lease_file) as f:
+                content = f.read()
+        except IOError:
+            continue
+
+        # dhclient: lease { interface "eth1"; fixed-address 10.0.0.5; ... }
+        for lease in re.findall(r'lease \{(.*?)\}', content, re.S):
+            m = re.search(r'fixed-address ([\d.]+);', lease)
+            if m and 'interface "%s";' % iface in lease:
+                address = m.group(1)
+
+        # NetworkManager internal and systemd-networkd: ADDRESS=10.0.0.5
+        name = os.path.basename(lease_file)
+        if name == ifindex or name.endswith('-%s.lease' % iface):
+            m = re.search(r'^ADDRESS=([\d.]+)$', content, re.M)
+            if m:
+                address = m.group(1)
+    return(address)
+
+
+def net_neighbor_addresses(args, iface):
+    '''Return the addresses in the kernel neighbor table for iface'''
+
+    out = run_shell(args, 'ip -4 neigh show dev %s' % iface)
+    return([line.split()[0] for line in out.splitlines() if line.strip()])
+
+
+def net_listen_for_addresses(iface, duration=5):
+    '''Passively collect the addresses seen in ARP and DHCP traffic on iface
+
+    Listen without sending anything, until a usable address is seen or for
+    at most duration seconds.
+    '''
+
+    ETH_P_ALL = 0x0003
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                         socket.htons(ETH_P_ALL))
+    sock.bind((iface, 0))
+
+    seen = []
+    deadline = time.time() + duration
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or \
+                    not select.select([sock], [], [], remaining)[0]:
+                break
+            frame = sock.recv(2048)
+            if len(frame) < 42:
+                continue
+            ethertype = struct.unpack('!H', frame[12:14])[0]
+            if ethertype == 0x0806:
+                # ARP sender and target protocol addresses
+                seen.append(socket.inet_ntoa(frame[28:32]))
+                seen.append(socket.inet_ntoa(frame[38:42]))
+            elif ethertype == 0x0800:
+                ihl, proto = struct.unpack('!B8xB', frame[14:24])
+                udp = 14 + (ihl & 0xf) * 4
+                if proto != 17 or len(frame) < udp + 28:
+                    continue
+                ports = struct.unpack('!HH', frame[udp:udp + 4])
+                if 67 in ports or 68 in ports:
+                    # DHCP server address and the "your address" field
+                    seen.append(socket.inet_ntoa(frame[26:30]))
+                    seen.append(socket.inet_ntoa(frame[udp + 24:udp + 28]))
+            if net_subnet_of(seen) is not None:
+                break
+    finally:
+        sock.close()
+    return(seen)
+
+
+def net_subnet_of(addresses):
+    '''Return the most common /24 subnet of a list of unicast addresses'''
+
+    subnets = Counter()
+    for ip in addresses:
+        first = int(ip.split('.')[0])
+        if ip != '0.0.0.0' and first < 224 and not ip.startswith('169.254.'):
+            subnets[ip[:ip.rfind('.')]] += 1
+    if not subnets:
+        return(None)
+    return(subnets.most_common(1)[0][0])
+
+
+def net_discover_subnet(args, iface, listen=5, dhcp_timeout=15):
+    '''Discover the /24 subnet on an interface that has no address
 
-    That can be used for the neutron subnet
+    Passive methods come first: the existing lease files, then the kernel
+    neighbor table, then listening for ARP and DHCP traffic for listen
+    seconds, as root through sudo_call. Only as a last resort briefly ask
+    DHCP for a lease, bounded by dhcp_timeout seconds, and release it
+    again.
 
-    Because the neutron interface does not have an ip address. Briefly ask
-    DHCP for one, then release it after extracting the lease
+    Return the subnet like "10.0.0", or None
     '''
 
+    address = net_lease_address(iface)
+    if address is not None:
+        logger.debug('%s subnet from DHCP lease file' % iface)
+        return(net_subnet_of([address]))
+
+    subnet = net_subnet_of(net_neighbor_addresses(args, iface))
+    if subnet is not None:
+        logger.debug('%s subnet from neighbor table' % iface)
+        return(subnet)
+
+    # Listening needs root, like probing
+    seen = None
+    if os.geteuid() != 0:
+        seen = sudo_call('net_listen_for_addresses', iface, listen)
+    if seen is None:
+        try:
+            seen = net_listen_for_addresses(iface, listen)
+        except (socket.error, IOError) as e:
+            print('  *Can not listen for ARP and DHCP traffic on %s (%s), '
+                  'that needs root. Asking DHCP instead*' % (iface, e))
+    subnet = net_subnet_of(seen or [])
+    if subnet is not None:
+        logger.debug('%s subnet from ARP/DHCP traffic' % iface)
+        return(subnet)
+
     # -v -r doesn't seem to work - so run seperately
     run_shell(args,
-              'sudo dhclient %s -v > /tmp/dhcp 2>&1' %
-              args.NEUTRON_INT)
+              'sudo timeout %d dhclient -1 %s -v > /tmp/dhcp 2>&1' %
+              (dhcp_timeout, iface))
 
     run_shell(args,
-              'sudo dhclient %s -r > /tmp/dhcp_r 2>&1' %
-              args.NEUTRON_INT)
+              'sudo timeout %d dhclient %s -r > /tmp/dhcp_r 2>&1' %
+              (dhcp_timeout, iface))
 
     out = run_shell(
         args,
         "cat /tmp/dhcp | grep -i 'bound to ' | awk '{ print $3 }'")
+    return(net_subnet_of(out.split()))
 
-    if out is None:
-        print('Kolla - no neutron subnet found, continuing but \
-        openstack likely not healthy')
-
-    subnet = out[:out.rfind(".")]
-    r = list(range(2, 253))
-    random.shuffle(r)
-    for k in r:
-        vip = run_shell(args, 'sudo nmap -sP -PR %s.%s' % (subnet, k))
-        if "Host seems down" in vip:
-            out = subnet + '.' + str(k)
-            break
-    return(subnet, out, k)
+
+def kolla_get_neutron_subnet(args, purpose='neutron-external', count=11):
+    '''Find and return a neutron ip address
+
+    That can be used for the neutron subnet, with count consecutive free
+    addresses starting at it for the external allocation pool
+
+    Because the neutron interface does not have an ip address, the subnet is
+    discovered passively where possible. The subnet found is remembered, so
+    this is only done once per host.
+    '''
+
+    subnet = net_get_fact(args, args.NEUTRON_INT, 'subnet')
+    if subnet is None:
+        subnet = net_discover_subnet(args, args.NEUTRON_INT)
+        if subnet is None:
+            print('Kolla - no neutron subnet found, continuing but '
+                  'openstack likely not healthy')
+            return(None, None, None)
+        net_set_fact(args, args.NEUTRON_INT, 'subnet', subnet)
+
+    return(kolla_allocate_on_subnet(args, args.NEUTRON_INT, subnet, purpose,
+                                    count))
 
 
 def kolla_setup_neutron(args):
@@ -2366,9 +4811,14 @@ def kolla_setup_neutron(args):
 
     neutron_subnet, neutron_start, octet = kolla_get_neutron_subnet(args)
     # neutron_subnet, neutron_start, octet = kolla_get_host_subnet(args)
+    if neutron_start is None:
+        raise AbortScriptException(
+            "Kolla - no free neutron external addresses found on %s"
+            % args.NEUTRON_INT)
     EXT_NET_CIDR = neutron_subnet + '.' + '0' + '/' + '24'
     EXT_NET_GATEWAY = neutron_subnet + '.' + '1'
-    # Because I don't own these - only use one that I know is safe
+    # Because I don't own these - only use ones that I know are safe and
+    # not handed out for anything else
     neutron_end = octet + 10
     EXT_NET_RANGE = 'start=%s,end=%s' % (
         neutron_start, neutron_subnet + '.' + str(neutron_end))
@@ -2377,6 +4827,9 @@ def kolla_setup_neutron(args):
         print('DEV: CIDR=%s, GW=%s, range=%s' %
               (EXT_NET_CIDR, EXT_NET_GATEWAY, EXT_NET_RANGE))
 
+    image_file = '/tmp/cirros-0.4.0-x86_64-disk.img'
+    fetch_artifact(args, CIRROS_URL, image_file)
+
     runonce = './runonce'
     with open(runonce, "w") as w:
         w.write("""
@@ -2389,6 +4842,7 @@ def kolla_setup_neutron(args):
 
 IMAGE_URL=http://download.cirros-cloud.net/0.4.0/
 IMAGE=cirros-0.4.0-x86_64-disk.img
+IMAGE_FILE='%s'
 IMAGE_NAME=cirros
 IMAGE_TYPE=linux
 EXT_NET_CIDR='%s'
@@ -2427,12 +4881,12 @@ if openstack image list | grep -q cirros; then
     exit
 fi
 
-if ! [ -f "${IMAGE}" ]; then
-    curl -L -o ./${IMAGE} ${IMAGE_URL}/${IMAGE}
+if ! [ -f "${IMAGE_FILE}" ]; then
+    curl -L -o ${IMAGE_FILE} ${IMAGE_URL}/${IMAGE}
 fi
 
 openstack image create --disk-format qcow2 --container-format bare --public \
-    --property os_type=${IMAGE_TYPE} --file ./${IMAGE} ${IMAGE_NAME}
+    --property os_type=${IMAGE_TYPE} --file ${IMAGE_FILE} ${IMAGE_NAME}
 
 openstack network create --external --provider-physical-network physnet1 \
     --provider-network-type flat public1
@@ -2510,7 +4964,7 @@ openstack server create \\
     --nic net-id=${DEMO_NET_ID} \\
     demo1
 EOF
-        """ % (EXT_NET_CIDR, EXT_NET_RANGE, EXT_NET_GATEWAY))
+        """ % (image_file, EXT_NET_CIDR, EXT_NET_RANGE, EXT_NET_GATEWAY))
 
 
 def kolla_nw_and_images(args):
@@ -2524,6 +4978,8 @@ def kolla_nw_and_images(args):
     if args.no_network:
         return
 
+    kolla_wait_for_apis(args, ['keystone', 'glance', 'nova', 'neutron',
+                               'placement'])
     kolla_setup_neutron(args)
 
     print_progress('Kolla',
@@ -2607,11 +5063,7 @@ def k8s_test_vip_int(args):
 
     # Allow the vip address to be the same as the mgmt_ip
     if args.vip_ip != args.mgmt_ip:
-        truth = run_shell(
-            args,
-            'sudo nmap -sP -PR %s | grep Host' %
-            args.vip_ip)
-        if re.search('Host is up', truth):
+        if net_probe(args.MGMT_INT, [args.vip_ip])[args.vip_ip].alive:
             print('Kubernetes - vip Interface %s is in use, '
                   'choose another' % args.vip_ip)
             sys.exit(1)
@@ -2738,9 +5190,14 @@ def k8s_bringup_kubernetes_cluster(args):
 
     if args.openstack:
         print('Kolla - Building OpenStack on existing Kubernetes cluster')
+        # docker is only restarted if the mirror is new to it
+        docker_setup_registry_mirror(args)
         return
 
     k8s_cleanup(args)
+    docker_setup_registry_mirror(args)
+    if not args.create_minion:
+        k8s_prepull_images(args)
     k8s_install_tools(args)
     k8s_setup_ntp(args)
     k8s_turn_things_off(args)
@@ -2874,6 +5331,7 @@ def kolla_bring_up_openstack(args):
     clean_progress()
     # Start Kolla deployment
     add_one_to_progress()
+    kolla_prepull_images(args)
     kolla_update_rbac(args)
     kolla_install_deploy_helm(args)
     kolla_install_repos(args)
@@ -2885,9 +5343,9 @@ def kolla_bring_up_openstack(args):
     node_list = ['kolla_compute', 'kolla_controller']
     kolla_label_nodes(args, node_list)
     kolla_modify_globals(args)
-    kolla_add_to_globals(args)
     kolla_gen_configs(args)
     kolla_enable_qemu(args)
+    kolla_set_neutron_mtu(args)
     kolla_gen_secrets(args)
     kolla_create_config_maps(args)
     kolla_resolve_workaround(args)
@@ -2899,46 +5357,33 @@ def kolla_bring_up_openstack(args):
     else:
         kolla_create_cloud(args)
 
+    graph = kolla_service_graph(args)
+    kolla_pull_rendered_images(args, graph)
+
     banner('Kolla - deploy OpenStack:')
 
     # If the user has supplied their own dockernhub account then assume self
     # built images and use that account
 
-    # Remove registry from cloud.yaml if user own registry
-    # if 'lokolla' not in args.docker_repo:
-    #     run_shell(args,
-    #               "sed -i '/docker_registry: 127.0.0.1:30401/d' "
-    #               "/tmp/cloud.yaml")
-
-    # Set up OVS for the Infrastructure
-    chart_list = ['openvswitch']
-    demo(args, 'Install %s Helm Chart' % chart_list, '')
-    helm_install_service_chart(args, chart_list)
-
-    # Bring up br-ex for keepalived to bind VIP to it
-    run_shell(args, 'sudo ifconfig br-ex up')
-
     # chart_list = ['keepalived-daemonset']
     # demo(args, 'Install %s Helm Chart' % chart_list, '')
     # helm_install_micro_service_chart(args, chart_list)
 
-    # Install Helm charts
-    chart_list = ['mariadb']
-    demo(args, 'Install %s Helm Chart' % chart_list, '')
-    helm_install_service_chart(args, chart_list)
-
-    # Install remaining service level charts
-    chart_list = ['rabbitmq', 'memcached', 'keystone', 'glance',
-                  'cinder-control', 'cinder-volume-lvm', 'horizon',
-                  'neutron']
-    demo(args, 'Install %s Helm Chart' % chart_list, '')
-    helm_install_service_chart(args, chart_list)
-
-    chart_list = ['nova-control', 'nova-compute']
-    demo(args, 'Install %s Helm Chart' % chart_list, '')
-    helm_install_service_chart(args, chart_list)
+    # Install the service charts in dependency order, each one as soon
+    # as the charts it needs are ready
+    demo(args, 'Install %s Helm Charts' % sorted(graph),
+         'Each chart starts once the charts it depends on are ready')
+    hooks = {'openvswitch': kolla_bring_up_br_ex}
+    if args.bulk_apply:
+        helm_bulk_apply(args, graph, hooks)
+    else:
+        helm_install_graph(args, graph, hooks)
+        k8s_wait_for_running_negate(args)
 
     kolla_install_logging(args)
+    kolla_report_image_pulls(args)
+    if args.bundle_save:
+        kolla_save_bundle(args)
 
     namespace_list = ['kube-system', 'kolla']
     k8s_get_pods(args, namespace_list)
@@ -2952,6 +5397,8 @@ def main():
     # Force sudo early on
     run_shell(args, 'sudo -v')
 
+    helm_check_bulk_apply(args)
+
     # Populate IP Addresses
     populate_ip_addresses(args)
 
@@ -2977,9 +5424,9 @@ def main():
     global KOLLA_FINAL_PROGRESS
     if re.search('5.', kolla_get_image_tag(args)):
         # Add one for additional docker registry pod bringup
-        KOLLA_FINAL_PROGRESS = 45
+        KOLLA_FINAL_PROGRESS = 47
     else:
-        KOLLA_FINAL_PROGRESS = 44
+        KOLLA_FINAL_PROGRESS = 46
 
     if args.no_network:
         KOLLA_FINAL_PROGRESS -= 4
@@ -2987,6 +5434,13 @@ def main():
     if args.no_git:
         KOLLA_FINAL_PROGRESS -= 1
 
+    if args.bundle_save:
+        KOLLA_FINAL_PROGRESS += 1
+
+    if args.bulk_apply:
+        # One render and five apply steps instead of twelve chart installs
+        KOLLA_FINAL_PROGRESS -= 6
+
     global K8S_CLEANUP_PROGRESS
     if os.path.exists('/data'):
         # Add one if we need to clean up LVM
@@ -2997,17 +5451,27 @@ def main():
     # Ubuntu does not need the selinux step
     global K8S_FINAL_PROGRESS
     if linux_ver() == 'centos':
-        K8S_FINAL_PROGRESS = 17
+        K8S_FINAL_PROGRESS = 18
     else:
-        K8S_FINAL_PROGRESS = 16
+        K8S_FINAL_PROGRESS = 17
 
     if args.create_minion:
         K8S_FINAL_PROGRESS = 5
 
+    if args.registry_mirror != 'None':
+        K8S_FINAL_PROGRESS += 1
+
     set_logging()
     logger.setLevel(level=args.verbose)
 
+    if args.reconfigure:
+        kolla_reconfigure(args)
+        return
+
     if args.complete_cleanup is not True:
+        prefetch_artifacts(args)
+        install_host_packages(args)
+        prefetch_repos(args)
         print_versions(args)
 
     try: